@@ -0,0 +1,89 @@
+"""
+bench_genai_client.py
+
+Before/after latency of the Gemini client setup against the local stub
+(stub_gemini_server.py), so no API key or network is needed.
+
+  before: a new genai.Client per session with default HTTP options (the old
+          get_genai_client), so the first turn of every session opens a new connection
+  after:  the process-wide pooled client from main.py, warmed up while the user
+          would be logging in / typing
+
+Usage:
+  python bench_genai_client.py --sessions 5 --turns 5 --handshake-ms 150 --ttft-ms 300
+"""
+
+import os
+import time
+import argparse
+import statistics
+
+from stub_gemini_server import StubConfig, start_stub_server
+
+
+def timed_turn(main, client, prompt):
+    """(time to first chunk, total time) of one streamed reply, in seconds."""
+    start = time.perf_counter()
+    first = []
+    main.generate_response_stream(client, "gemini-2.5-flash", "You are a benchmark.", prompt,
+                                  on_chunk=lambda text: first or first.append(time.perf_counter()))
+    end = time.perf_counter()
+    return (first[0] if first else end) - start, end - start
+
+
+def run(label, main, make_client, sessions, turns, think_s, config):
+    firsts, steady = [], []
+    connections = config.connections
+    for _ in range(sessions):
+        client = make_client()
+        time.sleep(think_s)  # user logging in / typing the first message
+        for turn in range(turns):
+            ttft, total = timed_turn(main, client, f"message {turn}")
+            (firsts if turn == 0 else steady).append((ttft, total))
+    opened = config.connections - connections
+
+    def ms(values):
+        return f"{statistics.median(values) * 1000:7.1f} ms"
+
+    print(f"{label:<8} first turn: ttft {ms([t for t, _ in firsts])}, total {ms([t for _, t in firsts])} | "
+          f"steady state: ttft {ms([t for t, _ in steady])}, total {ms([t for _, t in steady])} | "
+          f"connections opened: {opened}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the Gemini client against the local stub.")
+    ap.add_argument("--sessions", type=int, default=5)
+    ap.add_argument("--turns", type=int, default=5)
+    ap.add_argument("--think-ms", type=float, default=200, help="pause before the first turn of a session")
+    ap.add_argument("--handshake-ms", type=float, default=150)
+    ap.add_argument("--ttft-ms", type=float, default=300)
+    ap.add_argument("--chunk-ms", type=float, default=20)
+    args = ap.parse_args()
+
+    config = StubConfig(args.handshake_ms, args.ttft_ms, args.chunk_ms)
+    server, url = start_stub_server(0, config)
+    os.environ["GEMINI_BASE_URL"] = url
+    os.environ.setdefault("GEMINI_API_KEY", "stub-key")
+    import main as app  # reads GEMINI_BASE_URL at import
+    from google import genai
+    from google.genai import types
+
+    print(f"Stub at {url}: handshake {args.handshake_ms:.0f} ms, first chunk {args.ttft_ms:.0f} ms, "
+          f"{args.sessions} sessions x {args.turns} turns\n")
+
+    def old_client():
+        return genai.Client(api_key=os.environ["GEMINI_API_KEY"], http_options=types.HttpOptions(base_url=url))
+
+    def shared_client():
+        client = app.get_genai_client()
+        app.warm_up_genai_client(force=True)
+        return client
+
+    think_s = args.think_ms / 1000.0
+    run("before", app, old_client, args.sessions, args.turns, think_s, config)
+    run("after", app, shared_client, args.sessions, args.turns, think_s, config)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
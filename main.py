@@ -1,17 +1,31 @@
 
 import os
 import json
+import gzip
+import sqlite3
+import atexit
+import itertools
+import heapq
+import math
 
 import pandas as pd
+import numpy as np
+import httpx
 import tkinter as tk
 from tkinter import filedialog
 from datetime import datetime, timezone, timedelta
+from concurrent.futures import Future, wait, FIRST_COMPLETED
 from google import genai
 from google.genai import types
 import time
 import sys
 import threading
 import re
+import random
+import queue
+import hashlib
+import shutil
+from collections import Counter
 
 
 # ============ Color Configuration ============
@@ -107,11 +121,48 @@ class Colors:
     RESET = Style.RESET_ALL
 
 # ============ Configuration ============
-USERS_DB = "users_db.json"
+USERS_DB = "users_db.json"            # legacy store, imported into USERS_SQLITE on first run
+USERS_SQLITE = "users_db.sqlite3"
 CHAT_DB_DIR = "chat_histories"
-CSV_PREVIEW_MSGS = 300
+CORPUS_DIR = "chat_corpus"                 # imported chats per user, kept apart from the live log
+ANALYSIS_CHUNK_TOKENS = 12000              # approx. tokens of chat per map (chunk analysis) call
+ANALYSIS_WORKERS = 4                       # concurrent analysis calls (kept low for rate-limited keys)
+ANALYSIS_REDUCE_TOKENS = 24000             # approx. tokens of partial analyses per merge call; more are merged in rounds
+# Columns read from the parquet corpus written by make_csv_file.py (<name>_corpus/)
+CORPUS_COLUMNS = ["timestamp_ms", "sender", "text", "attachments"]
+CSV_CHUNK_ROWS = 100_000
+MEMORY_PAGE_SIZE = 20                      # memories per page in the /delete_memory listing
+MEMORY_SEARCH_LIMIT = 20                   # default result limit of /search_memory
+MEMORY_TOP_K = 15                          # most relevant memories put in the prompt each turn
+MEMORY_TOKEN_BUDGET = 1500                 # approx. token budget for the memory section
+MEMORY_INCLUDE_ALL = False                 # True: always send every memory (old behaviour)
+FEWSHOT_TOP_K = 6                          # owner replies to similar messages shown as examples
+FEWSHOT_TOKEN_BUDGET = 800                 # approx. token budget for the examples section
+FEWSHOT_MAX_GAP_S = 48 * 3600              # a reply must follow the message within this time
+CHAT_TAIL_MSGS = 40                        # recent messages given to the model each turn
+CHAT_LOG_COMPACT_BYTES = 8 * 1024 * 1024   # archive old log lines once the live log grows past this
+CHAT_LOG_KEEP_MSGS = 1000                  # messages left in the live log after compaction
+
+# Gemini HTTP transport: one pooled keep-alive client per process
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL") or "https://generativelanguage.googleapis.com/"
+GENAI_CONNECT_TIMEOUT_S = 10               # TCP + TLS setup
+GENAI_READ_TIMEOUT_S = 60                  # longest silence allowed between streamed chunks
+GENAI_MAX_CONNECTIONS = ANALYSIS_WORKERS + 4  # analysis calls plus chat turns
+GENAI_KEEPALIVE_S = 120                    # idle pooled connections are closed after this
+GENAI_DEADLINE_S = 120                     # whole generate call, retries included
+GENAI_MAX_ATTEMPTS = 4                     # requests per call (retries and hedge included)
+GENAI_BACKOFF_BASE_S = 0.5                 # first retry waits up to this, doubling per failure
+GENAI_BACKOFF_MAX_S = 8
+RESPONSE_CACHE_DB = "response_cache.sqlite3"  # on-disk cache of Gemini replies
+RESPONSE_CACHE_TTL_S = 30 * 24 * 3600      # entries older than this are misses
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # least recently used entries evicted past this
+RESPONSE_CACHE_CHAT = False                # chat turns use the cache too (toggle: /cache chat on|off)
+GENAI_HEDGE_AFTER_S = 6.0                  # no first chunk by then: send a second request (0 = off)
+ANALYSIS_READ_TIMEOUT_S = 300              # style analysis prompts are large: allow a long wait for chunks
+ANALYSIS_DEADLINE_S = 600                  # whole analysis call (map or reduce), retries included
 
 os.makedirs(CHAT_DB_DIR, exist_ok=True)
+os.makedirs(CORPUS_DIR, exist_ok=True)
 
 # ============ Loading Animation ============
 class LoadingSpinner:
@@ -165,29 +216,12 @@ def parse_time_string(time_str: str):
 
 
 def clean_expired_memories(username):
-    # Remove expired memories for the user.
-    users = load_users()
-    rec = users.get(username, {})
-    learning_facts = rec.get("learning", [])
-
-    now = datetime.now()
-    new_facts = []
-    expired = []
-
-    for lf in learning_facts:
-        text = lf["text"] if isinstance(lf, dict) else str(lf)
-        expiry = lf.get("expiry") if isinstance(lf, dict) else None
-
-        if expiry:
-            expiry_dt = datetime.fromisoformat(expiry)
-            if now >= expiry_dt:
-                expired.append(text)
-                continue
-        new_facts.append(lf)
-
+    # Report memories the background reaper removed. Costs O(1) unless something is due
+    # and the reaper thread has not got to it yet.
+    if EXPIRY_REAPER.is_due():
+        EXPIRY_REAPER.reap_due()
+    expired = EXPIRY_REAPER.take_notices(username)
     if expired:
-        users[username]["learning"] = new_facts
-        save_users(users)
         print_warning(f"Expired memories removed: {', '.join(expired)}\n")
 
 
@@ -232,61 +266,1377 @@ def print_box(text, color=Colors.PRIMARY):
     print(f"└─{'─' * max_len}─┘{Colors.RESET}")
 
 # ============ Storage Helpers ============
-def load_users():
-    if os.path.exists(USERS_DB):
-        with open(USERS_DB, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+# Users and memories live in an embedded SQLite database (WAL mode, one row per memory),
+# accessed through one process-wide cached UserStore (USER_STORE below).
+_USER_COLUMNS = ("created_at", "starting_command", "analysis", "analysis_generated_at")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    created_at TEXT,
+    starting_command TEXT,
+    analysis TEXT,
+    analysis_generated_at TEXT,
+    extra TEXT NOT NULL DEFAULT '{}',
+    last_sno INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS memories (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE,
+    sno INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    expiry TEXT,
+    expiry_ts INTEGER,
+    pinned INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_memories_user ON memories(username);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_memories_user_sno ON memories(username, sno);
+"""
+
+def _upgrade_schema(conn):
+    """Bring databases created by older versions up to the current schema."""
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(users)")}
+    if "last_sno" not in cols:
+        with conn:
+            conn.execute("ALTER TABLE users ADD COLUMN last_sno INTEGER NOT NULL DEFAULT 0")
+            conn.execute("UPDATE users SET last_sno = (SELECT COALESCE(MAX(sno), 0) FROM memories "
+                         "WHERE memories.username = users.username)")
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(memories)")}
+    if "expiry_ts" not in cols:
+        with conn:
+            conn.execute("ALTER TABLE memories ADD COLUMN expiry_ts INTEGER")
+            rows = conn.execute("SELECT id, expiry FROM memories WHERE expiry IS NOT NULL").fetchall()
+            conn.executemany("UPDATE memories SET expiry_ts = ? WHERE id = ?",
+                             [(expiry_to_ts(r[1]), r[0]) for r in rows])
+    if "pinned" not in cols:
+        with conn:
+            conn.execute("ALTER TABLE memories ADD COLUMN pinned INTEGER NOT NULL DEFAULT 0")
+    with conn:
+        conn.execute("DROP INDEX IF EXISTS idx_memories_expiry")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_memories_expiry_ts ON memories(expiry_ts) "
+                     "WHERE expiry_ts IS NOT NULL")
+
+def expiry_to_ts(expiry):
+    """ISO expiry string (local time, as stored since the JSON days) -> epoch seconds, or None."""
+    if not expiry:
+        return None
+    try:
+        return math.ceil(datetime.fromisoformat(expiry).timestamp())
+    except ValueError:
+        return None
+
+def normalize_memory_text(text):
+    """Key used for duplicate detection: case-folded, whitespace collapsed."""
+    return " ".join(str(text).casefold().split())
+
+def import_users_json(path, conn):
+    """One-shot importer for the old users_db.json (memories without SNo get one). Returns user count."""
+    with open(path, "r", encoding="utf-8") as f:
+        users = json.load(f)
+    with conn:
+        for username, rec in users.items():
+            fields = {k: rec.get(k) for k in _USER_COLUMNS}
+            extra = {k: v for k, v in rec.items() if k not in _USER_COLUMNS and k != "learning"}
+            conn.execute(
+                "INSERT OR REPLACE INTO users (username, created_at, starting_command, analysis, "
+                "analysis_generated_at, extra) VALUES (?, ?, ?, ?, ?, ?)",
+                (username, fields["created_at"], fields["starting_command"], fields["analysis"],
+                 fields["analysis_generated_at"], json.dumps(extra, ensure_ascii=False)))
+            facts = rec.get("learning", [])
+            next_sno = 1 + max((int(f["sno"]) for f in facts if isinstance(f, dict) and f.get("sno")), default=0)
+            seen = set()
+            for f in facts:
+                if isinstance(f, dict):
+                    sno, text, expiry = f.get("sno"), f.get("text", ""), f.get("expiry")
+                else:
+                    sno, text, expiry = None, str(f), None
+                if not sno or int(sno) in seen:
+                    sno = next_sno
+                    next_sno += 1
+                seen.add(int(sno))
+                conn.execute("INSERT INTO memories (username, sno, text, expiry, expiry_ts) VALUES (?, ?, ?, ?, ?)",
+                             (username, int(sno), text, expiry, expiry_to_ts(expiry)))
+            conn.execute("UPDATE users SET last_sno = ? WHERE username = ?",
+                         (max(seen | {next_sno - 1}), username))
+    return len(users)
+
+
+class TrigramIndex:
+    """
+    Inverted index trigram -> SNos over memory texts (lowercased). Substring queries
+    intersect the posting sets of the query's trigrams and only verify those candidates,
+    instead of scanning every memory. Queries shorter than 3 characters fall back to a scan.
+    """
+
+    def __init__(self):
+        self.postings = {}   # trigram -> set of SNos
+        self.texts = {}      # sno -> lowercased text
+
+    @staticmethod
+    def _grams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, sno, text):
+        low = text.lower()
+        self.texts[sno] = low
+        for g in self._grams(low):
+            self.postings.setdefault(g, set()).add(sno)
+
+    def remove(self, sno):
+        low = self.texts.pop(sno, None)
+        if low is None:
+            return
+        for g in self._grams(low):
+            bucket = self.postings.get(g)
+            if bucket is not None:
+                bucket.discard(sno)
+                if not bucket:
+                    del self.postings[g]
+
+    def search(self, query, limit=None):
+        """SNos whose text contains `query` (case-insensitive), ascending, at most `limit`."""
+        q = query.lower()
+        grams = self._grams(q)
+        if grams:
+            buckets = sorted((self.postings.get(g, set()) for g in grams), key=len)
+            candidates = set(buckets[0]).intersection(*buckets[1:])
+        else:
+            candidates = self.texts.keys()
+        hits = sorted(sno for sno in candidates if q in self.texts[sno])
+        return hits[:limit] if limit else hits
+
+
+STOPWORDS = frozenset("a an and are as at be but by do for from has have he her his i in is it its "
+                      "me my of on or she so that the their them they this to was we what when where "
+                      "who why will with you your".split())
+
+def tokenize(text):
+    return [t for t in re.findall(r"\w+", text.lower()) if t not in STOPWORDS]
+
+def estimate_tokens(text):
+    """Rough LLM token count (~4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+class Bm25Index:
+    """
+    Incremental BM25 index over short documents (memory texts), keyed by SNo.
+    search() scores only the documents that share a term with the query.
+    """
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.postings = {}   # term -> {sno: term frequency}
+        self.lengths = {}    # sno -> number of tokens
+        self.total_len = 0
+
+    def add(self, sno, text):
+        tokens = tokenize(text)
+        self.lengths[sno] = len(tokens)
+        self.total_len += len(tokens)
+        for term in tokens:
+            bucket = self.postings.setdefault(term, {})
+            bucket[sno] = bucket.get(sno, 0) + 1
+
+    def remove(self, sno, text):
+        if sno not in self.lengths:
+            return
+        self.total_len -= self.lengths.pop(sno)
+        for term in set(tokenize(text)):
+            bucket = self.postings.get(term)
+            if bucket is not None:
+                bucket.pop(sno, None)
+                if not bucket:
+                    del self.postings[term]
+
+    def search(self, query, k):
+        """Top-k (score, sno) pairs with a positive score, best first."""
+        n = len(self.lengths)
+        if not n:
+            return []
+        avg_len = self.total_len / n or 1
+        scores = {}
+        for term in set(tokenize(query)):
+            bucket = self.postings.get(term)
+            if not bucket:
+                continue
+            idf = math.log(1 + (n - len(bucket) + 0.5) / (len(bucket) + 0.5))
+            for sno, tf in bucket.items():
+                norm = tf + self.K1 * (1 - self.B + self.B * self.lengths[sno] / avg_len)
+                scores[sno] = scores.get(sno, 0.0) + idf * tf * (self.K1 + 1) / norm
+        return heapq.nlargest(k, ((sc, sno) for sno, sc in scores.items()))
+
+
+_INSERT_MEMORY_SQL = "INSERT INTO memories (username, sno, text, expiry, expiry_ts) VALUES (?, ?, ?, ?, ?)"
+_BUMP_LAST_SNO_SQL = "UPDATE users SET last_sno = MAX(last_sno, ?) WHERE username = ?"
+
+
+class UserStore:
+    """
+    Cached access to the users/memories database.
+
+    Reads are served from memory until the database changes underneath us: another
+    process or connection committing (PRAGMA data_version) or the file being replaced
+    (inode). Mutations update the cache right away, mark the user dirty and queue the
+    SQL; flush() writes everything queued in a single transaction, normally once at the
+    end of a chat turn. Counters: hits, misses, flushes, bytes_written.
+
+    Per user it also keeps a hash index normalized text -> SNo (constant-time duplicate
+    check) and the SNo high-water mark, persisted as users.last_sno, so SNos are never
+    reused even after the highest one is deleted.
+
+    A flush that fails leaves its statements queued for the next one and drops the
+    cached memories, so they are re-read from the database (queued ones show up once a
+    flush succeeds). If another process took an SNo that a queued memory was given,
+    that memory moves to the next free SNo and the flush is retried once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = None
+        self.inode = None
+        self.data_version = None
+        self.users = {}       # username -> record dict, or None if known not to exist
+        self.memories = {}    # username -> {sno: {"sno", "text", "expiry", "expiry_ts"}} in SNo order
+        self.text_index = {}  # username -> {normalized text: sno}
+        self.last_sno = {}    # username -> highest SNo ever assigned
+        self.trigrams = {}    # username -> TrigramIndex over memory texts
+        self.bm25 = {}        # username -> Bm25Index over memory texts
+        self.pending = []     # (sql, args) waiting for flush()
+        self.dirty = set()
+        self.stats = {"hits": 0, "misses": 0, "flushes": 0, "bytes_written": 0}
+
+    # ---- connection / invalidation ----
+    def _connect(self):
+        if self.conn is not None:
+            self.conn.close()
+        first_run = not os.path.exists(self.path)
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.executescript(_SCHEMA)
+        _upgrade_schema(conn)
+        if first_run and os.path.exists(USERS_DB):
+            count = import_users_json(USERS_DB, conn)
+            os.replace(USERS_DB, USERS_DB + ".imported")
+            print_info(f"Imported {count} user(s) from {USERS_DB} into {self.path}.")
+        self.conn = conn
+        self.inode = os.stat(self.path).st_ino
+        self.data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        self._clear()
+
+    def _clear(self):
+        self.users.clear()
+        self.memories.clear()
+        self.text_index.clear()
+        self.last_sno.clear()
+        self.trigrams.clear()
+        self.bm25.clear()
+
+    def _validate(self):
+        """Drop cached data if the database was changed by someone else since the last read."""
+        if self.conn is None:
+            self._connect()
+            return
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            inode = None
+        if inode != self.inode:
+            self._flush_locked()
+            self._connect()
+            return
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self.data_version:
+            self._flush_locked()
+            self.data_version = version
+            self._clear()
+
+    def _queue(self, username, sql, args):
+        self.pending.append((sql, args))
+        self.dirty.add(username)
+
+    def _write_pending_locked(self):
+        with self.conn:
+            for sql, args in self.pending:
+                self.conn.execute(sql, args)
+
+    def _flush_locked(self):
+        if not self.pending:
+            return 0
+        try:
+            try:
+                self._write_pending_locked()
+            except sqlite3.IntegrityError:
+                if not self._renumber_pending_locked():
+                    raise
+                self._drop_cache_locked()
+                self._write_pending_locked()
+        except sqlite3.Error:
+            self._drop_cache_locked()
+            raise
+        ops, self.pending = self.pending, []
+        self.stats["flushes"] += 1
+        self.stats["bytes_written"] += sum(len(str(a).encode("utf-8")) for _, args in ops for a in args)
+        self.dirty.clear()
+        return len(ops)
+
+    def _drop_cache_locked(self):
+        # records of users with queued updates are kept: they are what the flush will write,
+        # and re-reading them would let a later update_user queue the old values again
+        users = {u: self.users[u] for u in self.dirty if self.users.get(u) is not None}
+        self._clear()
+        self.users.update(users)
+
+    def _pending_snos(self, username):
+        return [args[1] for sql, args in self.pending if sql == _INSERT_MEMORY_SQL and args[0] == username]
+
+    def _renumber_pending_locked(self):
+        """
+        Give queued memories whose SNo is already in the database the next free ones
+        (another process saved memories meanwhile). Returns whether any moved.
+        """
+        moved = {}   # (username, old sno) -> new sno
+        nxt = {}     # username -> next free sno
+        for sql, args in self.pending:
+            if sql != _INSERT_MEMORY_SQL:
+                continue
+            username, sno = args[0], args[1]
+            if username not in nxt:
+                row = self.conn.execute(
+                    "SELECT MAX(COALESCE((SELECT MAX(sno) FROM memories WHERE username = ?), 0), "
+                    "COALESCE((SELECT last_sno FROM users WHERE username = ?), 0))", (username, username)).fetchone()
+                nxt[username] = row[0] + 1
+            if sno < nxt[username]:
+                moved[(username, sno)] = nxt[username]
+            nxt[username] = max(nxt[username], moved.get((username, sno), sno)) + 1
+        if not moved:
+            return False
+        ops = []
+        for sql, args in self.pending:
+            if sql == _INSERT_MEMORY_SQL:
+                args = (args[0], moved.get((args[0], args[1]), args[1])) + tuple(args[2:])
+            elif sql == _BUMP_LAST_SNO_SQL:
+                args = (moved.get((args[1], args[0]), args[0]), args[1])
+            elif "FROM memories" in sql or "UPDATE memories" in sql:
+                args = tuple(args[:-1]) + (moved.get((args[-2], args[-1]), args[-1]),)  # ... username, sno
+            ops.append((sql, args))
+        self.pending = ops
+        for (username, old), new in moved.items():
+            print_warning(f"Memory SNo {old} of {username} was taken by another session; saved as SNo {new}.")
+        return True
+
+    def flush(self):
+        """Write all queued changes in one transaction. Returns the number of statements."""
+        with self.lock:
+            if self.conn is None:
+                return 0
+            return self._flush_locked()
+
+    # ---- users ----
+    def get_user(self, username):
+        with self.lock:
+            self._validate()
+            if username in self.users:
+                self.stats["hits"] += 1
+            else:
+                self.stats["misses"] += 1
+                row = self.conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+                rec = None
+                if row:
+                    rec = json.loads(row["extra"] or "{}")
+                    rec.update({k: row[k] for k in _USER_COLUMNS})
+                self.users[username] = rec
+            rec = self.users[username]
+            return dict(rec) if rec is not None else None
+
+    def create_user(self, username, fields):
+        known = {k: fields.get(k) for k in _USER_COLUMNS}
+        extra = {k: v for k, v in fields.items() if k not in _USER_COLUMNS}
+        with self.lock:
+            self._validate()
+            self._queue(username,
+                "INSERT INTO users (username, created_at, starting_command, analysis, analysis_generated_at, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (username, known["created_at"], known["starting_command"], known["analysis"],
+                 known["analysis_generated_at"], json.dumps(extra, ensure_ascii=False)))
+            self._flush_locked()
+            self.users[username] = {**extra, **known}
+            self.memories[username] = {}
+            self.text_index[username] = {}
+            self.last_sno[username] = 0
+            self.trigrams[username] = TrigramIndex()
+            self.bm25[username] = Bm25Index()
+
+    def update_user(self, username, fields):
+        with self.lock:
+            rec = self.get_user(username)
+            if rec is None:
+                return False
+            rec.update(fields)
+            extra = {k: v for k, v in rec.items() if k not in _USER_COLUMNS}
+            self._queue(username,
+                "UPDATE users SET created_at = ?, starting_command = ?, analysis = ?, analysis_generated_at = ?, "
+                "extra = ? WHERE username = ?",
+                (rec["created_at"], rec["starting_command"], rec["analysis"], rec["analysis_generated_at"],
+                 json.dumps(extra, ensure_ascii=False), username))
+            self.users[username] = rec
+            return True
+
+    def delete_user(self, username):
+        with self.lock:
+            self._validate()
+            self._queue(username, "DELETE FROM users WHERE username = ?", (username,))
+            self._flush_locked()
+            self.users[username] = None
+            self.memories.pop(username, None)
+            self.text_index.pop(username, None)
+            self.last_sno.pop(username, None)
+            self.trigrams.pop(username, None)
+            self.bm25.pop(username, None)
+
+    # ---- memories ----
+    def get_memories(self, username):
+        """{sno: memory dict} for a user (the cached dict itself: do not modify)."""
+        with self.lock:
+            self._validate()
+            mems = self.memories.get(username)
+            if mems is not None:
+                self.stats["hits"] += 1
+                return mems
+            self.stats["misses"] += 1
+            rows = self.conn.execute(
+                "SELECT sno, text, expiry, expiry_ts, pinned FROM memories WHERE username = ? ORDER BY sno",
+                (username,)).fetchall()
+            mems = {r["sno"]: {"sno": r["sno"], "text": r["text"], "expiry": r["expiry"],
+                               "expiry_ts": r["expiry_ts"], "pinned": bool(r["pinned"])}
+                    for r in rows}
+            row = self.conn.execute("SELECT last_sno FROM users WHERE username = ?", (username,)).fetchone()
+            self.memories[username] = mems
+            self.text_index[username] = index = {}
+            self.trigrams[username] = grams = TrigramIndex()
+            self.bm25[username] = bm25 = Bm25Index()
+            for m in mems.values():
+                index.setdefault(normalize_memory_text(m["text"]), m["sno"])
+                grams.add(m["sno"], m["text"])
+                bm25.add(m["sno"], m["text"])
+            # memories still queued after a failed flush are not in the table yet
+            self.last_sno[username] = max([row["last_sno"] if row else 0] + list(mems) + self._pending_snos(username))
+            return mems
+
+    def find_memory(self, username, text):
+        """SNo of an existing memory with the same normalized text, or None."""
+        with self.lock:
+            self.get_memories(username)
+            return self.text_index[username].get(normalize_memory_text(text))
+
+    def add_memory(self, username, text, expiry=None):
+        """Store a new memory under the next SNo and return that SNo."""
+        with self.lock:
+            mems = self.get_memories(username)
+            if self.get_user(username) is None:
+                self._queue(username, "INSERT OR IGNORE INTO users (username) VALUES (?)", (username,))
+                self.users[username] = {k: None for k in _USER_COLUMNS}
+            sno = self.last_sno[username] + 1
+            self.last_sno[username] = sno
+            expiry_ts = expiry_to_ts(expiry)
+            self._queue(username, _INSERT_MEMORY_SQL, (username, sno, text, expiry, expiry_ts))
+            self._queue(username, _BUMP_LAST_SNO_SQL, (sno, username))
+            mems[sno] = {"sno": sno, "text": text, "expiry": expiry, "expiry_ts": expiry_ts, "pinned": False}
+            self.text_index[username].setdefault(normalize_memory_text(text), sno)
+            self.trigrams[username].add(sno, text)
+            self.bm25[username].add(sno, text)
+            return sno
+
+    def set_pinned(self, username, sno, pinned):
+        """Pin/unpin a memory; returns False if the SNo does not exist."""
+        with self.lock:
+            mems = self.get_memories(username)
+            if sno not in mems:
+                return False
+            mems[sno]["pinned"] = bool(pinned)
+            self._queue(username, "UPDATE memories SET pinned = ? WHERE username = ? AND sno = ?",
+                        (int(bool(pinned)), username, sno))
+            return True
+
+    def rank_memories(self, username, query, k):
+        """Top-k memories for `query` by BM25 score, best first."""
+        with self.lock:
+            mems = self.get_memories(username)
+            return [mems[sno] for _, sno in self.bm25[username].search(query, k)]
+
+    def search_memories(self, username, query, limit=None):
+        """Memories whose text contains `query` (case-insensitive), in SNo order."""
+        with self.lock:
+            mems = self.get_memories(username)
+            return [mems[sno] for sno in self.trigrams[username].search(query, limit)]
+
+    def delete_memories(self, username, snos):
+        """Delete the given SNos; returns the deleted memory dicts."""
+        with self.lock:
+            mems = self.get_memories(username)
+            index = self.text_index[username]
+            deleted = [mems.pop(sno) for sno in snos if sno in mems]
+            for m in deleted:
+                key = normalize_memory_text(m["text"])
+                if index.get(key) == m["sno"]:
+                    del index[key]
+                self.trigrams[username].remove(m["sno"])
+                self.bm25[username].remove(m["sno"], m["text"])
+                self._queue(username, "DELETE FROM memories WHERE username = ? AND sno = ?", (username, m["sno"]))
+            return deleted
+
+
+class ExpiryReaper:
+    """
+    Removes timed memories at their deadline. Expiries (epoch seconds) sit in a min-heap;
+    a daemon thread sleeps until the earliest one, deletes what is due and flushes.
+    Stale heap entries (memory deleted or re-saved) are skipped when popped. The removed
+    texts are kept as notices for the chat loop to print on the next turn.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.heap = []           # (expiry_ts, username, sno)
+        self.cond = threading.Condition()
+        self.notices = {}        # username -> [removed texts]
+        self.watched = set()
+        self.thread = None
+
+    def watch(self, username):
+        """Load a user's timed memories into the heap and make sure the thread runs."""
+        with self.cond:
+            if username not in self.watched:
+                self.watched.add(username)
+                for m in self.store.get_memories(username).values():
+                    if m.get("expiry_ts") is not None:
+                        heapq.heappush(self.heap, (m["expiry_ts"], username, m["sno"]))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def schedule(self, username, sno, expiry_ts):
+        if expiry_ts is None:
+            return
+        with self.cond:
+            heapq.heappush(self.heap, (expiry_ts, username, sno))
+            self.cond.notify()
+
+    def is_due(self):
+        """O(1): is anything past its deadline?"""
+        heap = self.heap
+        return bool(heap) and heap[0][0] <= time.time()
+
+    def reap_due(self):
+        """Delete every memory whose deadline has passed. Returns how many were removed."""
+        now = time.time()
+        due = {}
+        with self.cond:
+            while self.heap and self.heap[0][0] <= now:
+                ts, username, sno = heapq.heappop(self.heap)
+                due.setdefault(username, []).append((ts, sno))
+        removed = 0
+        for username, items in due.items():
+            mems = self.store.get_memories(username)
+            snos = [sno for ts, sno in items if sno in mems and mems[sno].get("expiry_ts") == ts]
+            deleted = self.store.delete_memories(username, snos)
+            if deleted:
+                with self.cond:
+                    self.notices.setdefault(username, []).extend(m["text"] for m in deleted)
+                removed += len(deleted)
+        if removed:
+            self.store.flush()
+        return removed
+
+    def take_notices(self, username):
+        with self.cond:
+            return self.notices.pop(username, [])
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                delay = self.heap[0][0] - time.time()
+                if delay > 0:
+                    self.cond.wait(timeout=min(delay, 3600))
+                    continue
+            try:
+                self.reap_due()
+            except Exception as e:
+                print_error(f"Expiry reaper error: {e}")
+                time.sleep(1)
+
+
+USER_STORE = UserStore(USERS_SQLITE)
+EXPIRY_REAPER = ExpiryReaper(USER_STORE)
+atexit.register(USER_STORE.flush)
+
+def get_user(username):
+    """User record (without memories) or None."""
+    return USER_STORE.get_user(username)
+
+def user_exists(username):
+    return USER_STORE.get_user(username) is not None
+
+def create_user(username, **fields):
+    USER_STORE.create_user(username, fields)
+
+def update_user(username, **fields):
+    """Set columns / extra keys on an existing user record."""
+    return USER_STORE.update_user(username, fields)
+
+def delete_user(username):
+    USER_STORE.delete_user(username)
 
-def save_users(users):
-    with open(USERS_DB, "w", encoding="utf-8") as f:
-        json.dump(users, f, indent=2, ensure_ascii=False)
+def get_memories(username):
+    """All memories of a user as [{"sno", "text", "expiry"}] ordered by SNo."""
+    return [dict(m) for m in USER_STORE.get_memories(username).values()]
+
+def count_memories(username):
+    return len(USER_STORE.get_memories(username))
+
+def flush_user_store():
+    """Persist pending user/memory changes (called at the end of each turn)."""
+    return USER_STORE.flush()
+
+def flush_turn_changes():
+    """flush_user_store() for the chat loop: a failed write is reported instead of ending the chat."""
+    try:
+        flush_user_store()
+    except sqlite3.Error as e:
+        print_error(f"Could not save memory/user changes ({e}); they are kept and saved with the next turn.\n")
+
+def print_store_stats():
+    st = USER_STORE.stats
+    total = st["hits"] + st["misses"]
+    rate = (100.0 * st["hits"] / total) if total else 0.0
+    print_info(f"User DB cache: {st['hits']} hits, {st['misses']} misses ({rate:.0f}% hit rate), "
+               f"{st['flushes']} flushes, {st['bytes_written']:,} bytes written, "
+               f"{len(USER_STORE.pending)} pending change(s)\n")
+
+# Chat history is an append-only JSON-lines log per user: one message per line, so a turn
+# is a single append and the recent messages are read from the end of the file.
+# Old lines are moved to a gzip archive by a background compaction.
+_chat_log_lock = threading.Lock()
+
+def _safe_username(username):
+    return "".join(ch for ch in username if ch.isalnum() or ch in ("_", "-")).strip() or username
 
 def get_user_chat_path(username):
-    safe = "".join(ch for ch in username if ch.isalnum() or ch in ("_", "-")).strip() or username
-    return os.path.join(CHAT_DB_DIR, f"{safe}_chat.json")
+    return os.path.join(CHAT_DB_DIR, f"{_safe_username(username)}_chat.jsonl")
+
+def get_user_chat_archive_path(username):
+    return os.path.join(CHAT_DB_DIR, f"{_safe_username(username)}_chat.archive.jsonl.gz")
+
+def get_legacy_chat_path(username):
+    return os.path.join(CHAT_DB_DIR, f"{_safe_username(username)}_chat.json")
+
+def _parse_chat_lines(lines):
+    out = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            out.append(json.loads(line))
+        except ValueError:
+            continue  # torn line from an interrupted append
+    return out
+
+def migrate_chat_history(username):
+    """Convert the old whole-file `<user>_chat.json` into the JSON-lines log (once)."""
+    legacy = get_legacy_chat_path(username)
+    if not os.path.exists(legacy):
+        return False
+    with _chat_log_lock:
+        if not os.path.exists(legacy):
+            return False
+        with open(legacy, "r", encoding="utf-8") as f:
+            history = json.load(f)
+        path = get_user_chat_path(username)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for m in history:
+                f.write(json.dumps(m, ensure_ascii=False) + "\n")
+            if os.path.exists(path):
+                # lines appended after the legacy file was written come last
+                with open(path, "r", encoding="utf-8") as cur:
+                    f.write(cur.read())
+        os.replace(tmp, path)
+        os.replace(legacy, legacy + ".migrated")
+    return True
 
 def load_chat_history(username):
+    """Full history (archive + live log). Prefer load_recent_chat_history for prompts."""
+    migrate_chat_history(username)
+    history = []
+    archive = get_user_chat_archive_path(username)
+    if os.path.exists(archive):
+        with gzip.open(archive, "rt", encoding="utf-8") as f:
+            history.extend(_parse_chat_lines(f))
     path = get_user_chat_path(username)
     if os.path.exists(path):
         with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
+            history.extend(_parse_chat_lines(f))
+    return history
+
+def _tail_lines(path, n, block=64 * 1024):
+    """Return the last n lines of a file by reading blocks backwards from the end."""
+    with open(path, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        data = b""
+        while pos > 0 and data.count(b"\n") <= n:
+            step = min(block, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = data.splitlines()
+    if pos > 0:
+        lines = lines[1:]  # first line is probably cut in half
+    return [l.decode("utf-8", errors="replace") for l in lines[-n:]]
+
+def load_recent_chat_history(username, n=CHAT_TAIL_MSGS):
+    """Last n messages, read from the end of the log without loading the whole history."""
+    migrate_chat_history(username)
+    path = get_user_chat_path(username)
+    recent = _parse_chat_lines(_tail_lines(path, n)) if os.path.exists(path) else []
+    if len(recent) < n and os.path.exists(get_user_chat_archive_path(username)):
+        # live log was just compacted below n messages: fall back to the full history
+        recent = load_chat_history(username)
+    return recent[-n:]
+
+def append_chat_history(username, messages):
+    """Append messages to the user's log: O(size of the new messages)."""
+    if not messages:
+        return
+    data = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages)
+    with _chat_log_lock:
+        with open(get_user_chat_path(username), "a", encoding="utf-8") as f:
+            f.write(data)
 
 def save_chat_history(username, history):
+    """Replace the whole history (used when creating an account)."""
+    path = get_user_chat_path(username)
+    tmp = path + ".tmp"
+    with _chat_log_lock:
+        with open(tmp, "w", encoding="utf-8") as f:
+            for m in history:
+                f.write(json.dumps(m, ensure_ascii=False) + "\n")
+        os.replace(tmp, path)
+        archive = get_user_chat_archive_path(username)
+        if os.path.exists(archive):
+            os.remove(archive)
+
+def compact_chat_history(username):
+    """
+    Move all but the last CHAT_LOG_KEEP_MSGS lines of a large live log into the gzip
+    archive, so the live log stays small. Returns the number of archived messages.
+    """
     path = get_user_chat_path(username)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(history, f, indent=2, ensure_ascii=False)
+    with _chat_log_lock:
+        if not os.path.exists(path) or os.path.getsize(path) < CHAT_LOG_COMPACT_BYTES:
+            return 0
+        with open(path, "r", encoding="utf-8") as f:
+            lines = [l for l in f if l.strip()]
+        if len(lines) <= CHAT_LOG_KEEP_MSGS:
+            return 0
+        old, keep = lines[:-CHAT_LOG_KEEP_MSGS], lines[-CHAT_LOG_KEEP_MSGS:]
+        with gzip.open(get_user_chat_archive_path(username), "at", encoding="utf-8") as f:
+            f.writelines(old)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(keep)
+        os.replace(tmp, path)
+    return len(old)
+
+def start_chat_compaction(username):
+    """Run compact_chat_history in a background thread (no-op for small logs)."""
+    t = threading.Thread(target=compact_chat_history, args=(username,), daemon=True)
+    t.start()
+    return t
+
+def delete_chat_history(username):
+    for path in (get_user_chat_path(username), get_user_chat_archive_path(username),
+                 get_legacy_chat_path(username), get_legacy_chat_path(username) + ".migrated"):
+        if os.path.exists(path):
+            os.remove(path)
+
+# ============ Chat Corpus Store ============
+# Chats imported at signup or with /upload_new_chat_data live in a separate, read-mostly
+# JSON-lines corpus per user. The live log above only holds the assistant conversation
+# ("You" / "AI" messages), so turns never touch the corpus and RECENT CONVERSATION is
+# never filled with imported messages. Indexes derived from the corpus (few-shot index)
+# are cached next to it and rebuilt only when the corpus file changes.
+# Every stored message has a 64-bit content hash (timestamp|sender|text) in a side file,
+# so re-uploading an export (or an overlapping one) only adds the messages not seen yet.
+# An upload that must be merged into an existing analysis is first staged as a pending
+# delta and only appended (hashes included) once the merged analysis is saved, so a
+# failed, cancelled or interrupted analysis leaves those messages "new" for the next try.
+LIVE_SENDERS = ("You", "AI")   # senders of the assistant's own conversation
+_corpus_lock = threading.Lock()
+
+def get_user_corpus_path(username):
+    return os.path.join(CORPUS_DIR, f"{_safe_username(username)}_corpus.jsonl")
+
+def get_corpus_hashes_path(username):
+    return os.path.join(CORPUS_DIR, f"{_safe_username(username)}_corpus.hashes")
+
+def get_pending_delta_paths(username):
+    base = os.path.join(CORPUS_DIR, f"{_safe_username(username)}_corpus.pending")
+    return base + ".jsonl", base + ".hashes"
+
+def message_hash(m):
+    key = f"{str(m.get('timestamp') or '').strip()}|{m.get('sender') or ''}|{m.get('text') or ''}"
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+def _dedup(chats, known):
+    """(chats whose hash is not in `known` (a sorted array) nor earlier in `chats`, their hashes)."""
+    if not chats:
+        return [], np.zeros(0, dtype="<u8")
+    hashes = np.fromiter((message_hash(m) for m in chats), dtype="<u8", count=len(chats))
+    _, first = np.unique(hashes, return_index=True)
+    keep = np.zeros(len(chats), dtype=bool)
+    keep[first] = True
+    if len(known):
+        pos = np.minimum(np.searchsorted(known, hashes), len(known) - 1)
+        keep &= known[pos] != hashes
+    idx = np.flatnonzero(keep)
+    return [chats[i] for i in idx], hashes[idx]
+
+def _write_new_messages(username, chunks, jsonl_path, hashes_path, mode):
+    """
+    Write the messages of `chunks` (an iterable of chat lists, e.g. CSV chunks) that are
+    not in the corpus yet, one chunk at a time, so memory is bounded by one chunk plus
+    8 bytes per known message. Returns (messages read, messages written).
+    """
+    known = np.sort(load_corpus_hashes(username))
+    read = written = 0
+    with open(jsonl_path, mode, encoding="utf-8") as fj, open(hashes_path, mode + "b") as fh:
+        for chats in chunks:
+            new, hashes = _dedup(chats, known)
+            read += len(chats)
+            if not new:
+                continue
+            fj.write("".join(json.dumps(m, ensure_ascii=False) + "\n" for m in new))
+            fh.write(hashes.tobytes())
+            known = np.insert(known, np.searchsorted(known, np.sort(hashes)), np.sort(hashes))
+            written += len(new)
+    return read, written
+
+def load_corpus_hashes(username):
+    """Hashes of every stored message; rebuilt from the corpus if the side file is missing."""
+    path = get_corpus_hashes_path(username)
+    if os.path.exists(path):
+        return np.fromfile(path, dtype="<u8")
+    corpus = load_corpus_messages(username)
+    hashes = np.fromiter((message_hash(m) for m in corpus), dtype="<u8", count=len(corpus))
+    if os.path.exists(get_user_corpus_path(username)):
+        hashes.tofile(path)
+    return hashes
+
+def get_fewshot_cache_paths(username):
+    base = os.path.join(CORPUS_DIR, f"{_safe_username(username)}_fewshot")
+    return base + ".npz", base + "_pairs.jsonl"
+
+def corpus_key(username):
+    """(size, mtime_ns) of the corpus file: changes whenever chats are added."""
+    try:
+        st = os.stat(get_user_corpus_path(username))
+    except OSError:
+        return (0, 0)
+    return (st.st_size, st.st_mtime_ns)
+
+def write_corpus(username, chats):
+    """Replace the user's corpus (signup); duplicate messages are stored once. Returns the stored chats."""
+    chats, hashes = _dedup(chats, np.zeros(0, dtype="<u8"))
+    path = get_user_corpus_path(username)
+    tmp = path + ".tmp"
+    with _corpus_lock:
+        with open(tmp, "w", encoding="utf-8") as f:
+            for m in chats:
+                f.write(json.dumps(m, ensure_ascii=False) + "\n")
+        hashes.tofile(get_corpus_hashes_path(username))
+        os.replace(tmp, path)
+    return chats
+
+def add_to_corpus(username, chunks):
+    """
+    Append the messages of `chunks` (an iterable of chat lists) that are not in the user's
+    corpus yet (by content hash). Returns (messages read, messages added).
+    """
+    with _corpus_lock:
+        return _write_new_messages(username, chunks, get_user_corpus_path(username),
+                                   get_corpus_hashes_path(username), "a")
+
+def stage_corpus_delta(username, chunks):
+    """
+    Write the messages of `chunks` that are not in the user's corpus yet to the pending
+    delta (replacing an earlier one) without touching the corpus. Returns (read, new).
+    """
+    jsonl_path, hashes_path = get_pending_delta_paths(username)
+    with _corpus_lock:
+        return _write_new_messages(username, chunks, jsonl_path, hashes_path, "w")
+
+def pending_delta_token(username):
+    """Identifies the staged delta (digest of its hashes), or None if there is none."""
+    _, hashes_path = get_pending_delta_paths(username)
+    try:
+        with open(hashes_path, "rb") as f:
+            return hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+    except OSError:
+        return None
+
+def discard_corpus_delta(username):
+    with _corpus_lock:
+        for path in get_pending_delta_paths(username):
+            if os.path.exists(path):
+                os.remove(path)
+
+def commit_corpus_delta(username):
+    """Append the staged delta to the corpus and its hashes. Returns whether there was one."""
+    jsonl_path, hashes_path = get_pending_delta_paths(username)
+    with _corpus_lock:
+        if not os.path.exists(hashes_path):
+            return False
+        # corpus first: a crash in between re-adds a few messages rather than losing them
+        for src, dst in ((jsonl_path, get_user_corpus_path(username)), (hashes_path, get_corpus_hashes_path(username))):
+            with open(src, "rb") as fin, open(dst, "ab") as fout:
+                shutil.copyfileobj(fin, fout)
+        os.remove(jsonl_path)
+        os.remove(hashes_path)
+    return True
+
+def recover_corpus_delta(username):
+    """
+    Finish or drop a delta left behind by an interrupted import: it is committed if the
+    analysis it was merged into was saved (the user record holds its token), else dropped.
+    """
+    token = pending_delta_token(username)
+    if token is None:
+        return False
+    if (get_user(username) or {}).get("corpus_delta") == token:
+        return commit_corpus_delta(username)
+    discard_corpus_delta(username)
+    return False
+
+def load_corpus_messages(username):
+    path = get_user_corpus_path(username)
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return _parse_chat_lines(f)
+
+def iter_corpus_messages(path):
+    """Stream the messages of a corpus (or pending delta) file without loading it whole."""
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            yield from _parse_chat_lines([line])
+
+def load_corpus_frame(paths, chunksize=CSV_CHUNK_ROWS):
+    """
+    The messages of one or more corpus files as a columnar DataFrame (string columns),
+    built chunk by chunk so only one chunk is ever held as Python dicts.
+    """
+    columns = ["timestamp", "sender", "text", "attachments"]
+    frames = []
+    messages = itertools.chain.from_iterable(iter_corpus_messages(p) for p in paths)
+    while True:
+        batch = list(itertools.islice(messages, chunksize))
+        if not batch:
+            break
+        frames.append(pd.DataFrame.from_records(batch, columns=columns).astype("string"))
+    if not frames:
+        return pd.DataFrame(columns=columns, dtype="string")
+    return pd.concat(frames, ignore_index=True)
+
+def migrate_chat_corpus(username):
+    """
+    Split a log written before the corpus store existed (imported rows mixed with the
+    conversation) into the corpus and a live log of "You" / "AI" messages only.
+    Runs once: afterwards the corpus file exists, even if it is empty.
+    """
+    if os.path.exists(get_user_corpus_path(username)):
+        return 0
+    history = load_chat_history(username)
+    imported = [m for m in history if m.get("sender") not in LIVE_SENDERS]
+    if imported:
+        live = [m for m in history if m.get("sender") in LIVE_SENDERS]
+        save_chat_history(username, live)
+    write_corpus(username, imported)
+    return len(imported)
+
+def delete_corpus(username):
+    for path in ((get_user_corpus_path(username), get_corpus_hashes_path(username))
+                 + get_pending_delta_paths(username) + get_fewshot_cache_paths(username)):
+        if os.path.exists(path):
+            os.remove(path)
 
 # ============ Gemini Client ============
+# One genai.Client for the whole process, on top of a pooled httpx client, so every call
+# after the first reuses an open keep-alive connection instead of paying for TCP + TLS.
+GENAI_TIMEOUT = httpx.Timeout(connect=GENAI_CONNECT_TIMEOUT_S, read=GENAI_READ_TIMEOUT_S,
+                              write=GENAI_CONNECT_TIMEOUT_S, pool=GENAI_CONNECT_TIMEOUT_S)
+_genai_lock = threading.Lock()
+_genai_client = None
+_genai_http = None
+_genai_last_used = 0.0
+
+
+class _PhaseTimeoutTransport(httpx.HTTPTransport):
+    """
+    The SDK sends one flat timeout per request (or none); apply GENAI_TIMEOUT's per-phase
+    values instead. A flat timeout set for one call (generate_response_stream's
+    read_timeout_s) replaces only the read timeout.
+    """
+    def handle_request(self, request):
+        timeout = GENAI_TIMEOUT.as_dict()
+        read = (request.extensions.get("timeout") or {}).get("read")
+        if read is not None:
+            timeout["read"] = read
+        request.extensions["timeout"] = timeout
+        return super().handle_request(request)
+
+
+def build_genai_client(api_key, base_url=GEMINI_BASE_URL):
+    """A genai.Client with a pooled keep-alive transport; returns (client, httpx client)."""
+    http = httpx.Client(
+        transport=_PhaseTimeoutTransport(limits=httpx.Limits(
+            max_connections=GENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=GENAI_MAX_CONNECTIONS,
+            keepalive_expiry=GENAI_KEEPALIVE_S)),
+        timeout=GENAI_TIMEOUT,
+    )
+    options = types.HttpOptions(base_url=base_url, httpx_client=http)
+    return genai.Client(api_key=api_key, http_options=options), http
+
 def get_genai_client():
-    api_key = "YOUR_GEMINI_API_KEY"
-    if not api_key:
-        print_error("Set GEMINI_API_KEY environment variable.")
-        raise SystemExit(1)
-    return genai.Client(api_key=api_key)
-
-def _get_next_sno_for_user(users_rec):
-    """Return the next sno (monotonic) for a user's learning list."""
-    facts = users_rec.get("learning", [])
-    if not facts:
-        return 1
-    max_sno = 0
-    for f in facts:
-        if isinstance(f, dict) and f.get("sno"):
-            try:
-                s = int(f.get("sno"))
-                if s > max_sno:
-                    max_sno = s
-            except Exception:
-                pass
-    return max_sno + 1
+    """The process-wide client, created on first use."""
+    global _genai_client, _genai_http
+    with _genai_lock:
+        if _genai_client is None:
+            api_key = os.environ.get("GEMINI_API_KEY") or "YOUR_GEMINI_API_KEY"
+            if not api_key:
+                print_error("Set GEMINI_API_KEY environment variable.")
+                raise SystemExit(1)
+            _genai_client, _genai_http = build_genai_client(api_key)
+            atexit.register(_genai_http.close)
+        return _genai_client
+
+def warm_up_genai_client(force=False):
+    """
+    Open a pooled connection to the API in a background thread (while the user logs in or
+    types), so the next request skips connection setup. Does nothing if a request went out
+    recently enough for its connection to still be alive, unless force is set.
+    """
+    if not force and time.time() - _genai_last_used < GENAI_KEEPALIVE_S * 0.8:
+        return None
+
+    def run():
+        global _genai_last_used
+        try:
+            get_genai_client()
+            _genai_http.head(GEMINI_BASE_URL)
+            _genai_last_used = time.time()
+        except Exception:
+            pass  # warm-up is best effort; the real request reports errors
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    return t
+
+# ---- resilient generation ----
+# Every request runs in its own thread and feeds a queue, so the caller can enforce the
+# deadline, start a hedged second request when the first chunk is late and back off
+# between retries. A call is only retried while nothing has been emitted yet: once the
+# first chunk reached on_chunk the reply (and any directive in it) belongs to that
+# request, and a failure keeps the partial text instead of starting over.
+GENAI_STATS = {"calls": 0, "requests": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "errors": 0}
+
+
+class GenerationError(Exception):
+    """A generate call that failed for good; `partial` is the text already emitted."""
+    def __init__(self, kind, cause, attempts, partial=""):
+        super().__init__(f"{kind} after {attempts} request(s): {cause}")
+        self.kind = kind
+        self.cause = cause
+        self.attempts = attempts
+        self.partial = partial
+
+
+def classify_genai_error(exc):
+    """'rate_limited' (429), 'transient' (408, 5xx, network/timeouts) or 'permanent' (other 4xx, bugs)."""
+    code = getattr(exc, "code", None)
+    if isinstance(code, int):
+        if code == 429:
+            return "rate_limited"
+        if code == 408 or code >= 500:
+            return "transient"
+        return "permanent"
+    if isinstance(exc, (httpx.TransportError, ConnectionError, TimeoutError)):
+        return "transient"
+    return "permanent"
+
+def backoff_delay(failures, exc=None):
+    """Full-jitter exponential backoff; honours Retry-After on rate limiting."""
+    delay = random.uniform(0, min(GENAI_BACKOFF_MAX_S, GENAI_BACKOFF_BASE_S * 2 ** (failures - 1)))
+    response = getattr(exc, "response", None)
+    retry_after = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            delay = max(delay, min(float(retry_after), GENAI_BACKOFF_MAX_S))
+        except ValueError:
+            pass
+    return delay
+
+def _stream_attempt(client, model, contents, config, out, attempt, cancel):
+    try:
+        stream = client.models.generate_content_stream(model=model, contents=contents, config=config)
+        for chunk in stream:
+            if cancel.is_set():
+                stream.close()
+                return
+            text = getattr(chunk, "text", None)
+            if text:
+                out.put((attempt, "chunk", text))
+        out.put((attempt, "done", None))
+    except Exception as e:
+        out.put((attempt, "error", e))
+
+def stream_generate(client, model, contents, config, on_chunk=None,
+                    deadline_s=GENAI_DEADLINE_S, hedge_after_s=GENAI_HEDGE_AFTER_S, cancel=None):
+    """
+    Stream one reply with a deadline, retries with jittered backoff for rate limiting and
+    transient errors, and a hedged second request if no chunk arrived after hedge_after_s.
+    Setting `cancel` (threading.Event) abandons the call within a fraction of a second.
+    Returns (text, info) where info has "attempts" and "hedged"; raises GenerationError.
+    """
+    now = time.monotonic()
+    deadline = now + deadline_s
+    out = queue.Queue()
+    cancels = {}
+    live = set()
+    parts = []
+    winner = None
+    failures = 0
+    last_error = None
+    next_retry_at = None
+    hedged = False
+
+    def launch():
+        attempt = len(cancels) + 1
+        cancels[attempt] = threading.Event()
+        live.add(attempt)
+        GENAI_STATS["requests"] += 1
+        threading.Thread(target=_stream_attempt, daemon=True,
+                         args=(client, model, contents, config, out, attempt, cancels[attempt])).start()
+        return time.monotonic() + hedge_after_s if hedge_after_s else None
+
+    def fail(kind, cause):
+        for ev in cancels.values():
+            ev.set()
+        GENAI_STATS["errors"] += 1
+        raise GenerationError(kind, cause, len(cancels), "".join(parts))
+
+    GENAI_STATS["calls"] += 1
+    hedge_at = launch()
+    while True:
+        now = time.monotonic()
+        if cancel is not None and cancel.is_set():
+            fail("cancelled", "cancelled by the caller")
+        if now >= deadline:
+            fail("deadline", last_error or f"no complete reply within {deadline_s}s")
+        if next_retry_at is not None and now >= next_retry_at:
+            next_retry_at = None
+            GENAI_STATS["retries"] += 1
+            hedge_at = launch()
+        if winner is None and hedge_at is not None and now >= hedge_at:
+            hedge_at = None
+            if len(live) == 1 and len(cancels) < GENAI_MAX_ATTEMPTS:
+                hedged = True
+                GENAI_STATS["hedges"] += 1
+                launch()
+        wake = min(t for t in (deadline, hedge_at if winner is None else None, next_retry_at,
+                               now + 0.2 if cancel is not None else None) if t is not None)
+        try:
+            attempt, kind, payload = out.get(timeout=max(0.0, wake - now))
+        except queue.Empty:
+            continue
+        if winner is not None and attempt != winner:
+            continue
+        if kind == "chunk":
+            if winner is None:
+                winner = attempt
+                if hedged and attempt == max(cancels):
+                    GENAI_STATS["hedge_wins"] += 1
+                for other, ev in cancels.items():
+                    if other != attempt:
+                        ev.set()
+            parts.append(payload)
+            if on_chunk is not None:
+                on_chunk(payload)
+        elif kind == "done":
+            for other, ev in cancels.items():
+                if other != attempt:
+                    ev.set()
+            return "".join(parts), {"attempts": len(cancels), "hedged": hedged}
+        else:
+            live.discard(attempt)
+            last_error = payload
+            if winner is not None:
+                fail("interrupted", payload)  # text already emitted: never retried
+            error_kind = classify_genai_error(payload)
+            if error_kind == "permanent":
+                fail(error_kind, payload)
+            if live:
+                continue  # the other (hedged) request may still succeed
+            failures += 1
+            if len(cancels) >= GENAI_MAX_ATTEMPTS:
+                fail(error_kind, payload)
+            next_retry_at = time.monotonic() + backoff_delay(failures, payload)
+            hedge_at = None
+            if next_retry_at >= deadline:
+                fail(error_kind, payload)
+
+
+# ---- response cache ----
+class ResponseCache:
+    """
+    Content-addressed cache of Gemini replies in SQLite, keyed by sha256 of
+    (model, system instruction, prompt). Entries expire after `ttl_s`; when the stored
+    text passes `max_bytes` the least recently used entries are evicted.
+    Counters: hits, misses, stores, evictions.
+    """
+
+    def __init__(self, path, ttl_s=RESPONSE_CACHE_TTL_S, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl_s = ttl_s
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = None
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def key(model, system_instruction_text, user_prompt_text):
+        payload = json.dumps([model, system_instruction_text, user_prompt_text], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _db(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses(last_used);
+            """)
+        return self.conn
+
+    def get(self, key):
+        """Cached reply text or None."""
+        now = time.time()
+        with self.lock:
+            db = self._db()
+            row = db.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl_s:
+                if row is not None:
+                    with db:
+                        db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.stats["misses"] += 1
+                return None
+            with db:
+                db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.stats["hits"] += 1
+            return row[0]
+
+    def put(self, key, model, response):
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self.lock:
+            db = self._db()
+            with db:
+                db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                           (key, model, response, size, now, now))
+                self.stats["stores"] += 1
+                total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_bytes:
+                    for old_key, old_size in db.execute(
+                            "SELECT key, size FROM responses ORDER BY last_used").fetchall():
+                        if total <= self.max_bytes:
+                            break
+                        db.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                        total -= old_size
+                        self.stats["evictions"] += 1
+
+    def clear(self, expired_only=False):
+        """Remove every entry (or only the expired ones); returns how many were removed."""
+        with self.lock:
+            db = self._db()
+            with db:
+                if expired_only:
+                    cur = db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_s,))
+                else:
+                    cur = db.execute("DELETE FROM responses")
+            return cur.rowcount
+
+    def summary(self):
+        with self.lock:
+            entries, size = self._db().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return entries, size
 
 
-def generate_response_stream(client, model, system_instruction_text, user_prompt_text):
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_DB)
+
+def print_cache_stats(chat_enabled):
+    st = RESPONSE_CACHE.stats
+    total = st["hits"] + st["misses"]
+    rate = (100.0 * st["hits"] / total) if total else 0.0
+    entries, size = RESPONSE_CACHE.summary()
+    print_info(f"Response cache: {entries} entries, {size:,} bytes | {st['hits']} hits, {st['misses']} misses "
+               f"({rate:.0f}% hit rate), {st['evictions']} evicted | chat turns: {'on' if chat_enabled else 'off'}\n")
+
+
+def generate_response_stream(client, model, system_instruction_text, user_prompt_text, on_chunk=None,
+                             deadline_s=GENAI_DEADLINE_S, hedge_after_s=0, info=None, use_cache=False,
+                             cacheable=None, quiet=False, read_timeout_s=None, cancel=None):
     """
-    Fixed version: properly handles None values in streaming chunks
+    Fixed version: properly handles None values in streaming chunks.
+    on_chunk (optional) is called with each piece of text as soon as it arrives.
+    Retries, deadline and hedging: see stream_generate. Hedging is off unless hedge_after_s
+    is given (chat turns use GENAI_HEDGE_AFTER_S; long analysis prompts are slow to start
+    anyway). `info` (optional dict) receives the attempts/hedged details of the call.
+    With use_cache the reply is looked up in / stored to RESPONSE_CACHE; a hit is passed
+    to on_chunk in one piece. Failed calls are never cached, nor replies for which
+    cacheable(text) (optional) is false; such a reply found in the cache counts as a
+    miss. quiet skips the error print (background jobs must not write over the chat
+    prompt; the error is still in `info`). read_timeout_s replaces GENAI_READ_TIMEOUT_S
+    for this call; `cancel` is passed to stream_generate.
     """
+    cache_key = None
+    if use_cache:
+        cache_key = ResponseCache.key(model, system_instruction_text, user_prompt_text)
+        cached = RESPONSE_CACHE.get(cache_key)
+        if cached is not None and (cacheable is None or cacheable(cached)):
+            if info is not None:
+                info.update(attempts=0, cached=True)
+            if on_chunk is not None and cached:
+                on_chunk(cached)
+            return cached
     contents = [
         types.Content(
             role="user",
@@ -295,57 +1645,986 @@ def generate_response_stream(client, model, system_instruction_text, user_prompt
     ]
     config = types.GenerateContentConfig(
         temperature=1.45,
-        system_instruction=[types.Part.from_text(text=system_instruction_text)]
+        system_instruction=[types.Part.from_text(text=system_instruction_text)],
+        http_options=types.HttpOptions(timeout=int(read_timeout_s * 1000)) if read_timeout_s else None
     )
-    response_text = ""
+    global _genai_last_used
+    _genai_last_used = time.time()
     try:
-        for chunk in client.models.generate_content_stream(
-            model=model,
-            contents=contents,
-            config=config
-        ):
-            if hasattr(chunk, 'text') and chunk.text is not None:
-                response_text += chunk.text
-            elif hasattr(chunk, 'text') and chunk.text == "":
-                continue
-                
-    except Exception as e:
-        print_error(f"Error generating response: {e}")
+        response_text, details = stream_generate(client, model, contents, config, on_chunk,
+                                                 deadline_s=deadline_s, hedge_after_s=hedge_after_s,
+                                                 cancel=cancel)
+        if info is not None:
+            info.update(details)
+        if cache_key is not None and response_text and (cacheable is None or cacheable(response_text)):
+            RESPONSE_CACHE.put(cache_key, model, response_text)
+    except GenerationError as e:
+        if not quiet:
+            print_error(f"Error generating response: {e}")
+        if info is not None:
+            info.update(attempts=e.attempts, error=e.kind)
+        if on_chunk is not None and e.partial:
+            return e.partial  # part of the reply is already on screen: keep it
         response_text = "Sorry, I couldn't get a response right now."
+        if on_chunk is not None:
+            on_chunk(response_text)
+    _genai_last_used = time.time()
     
     return response_text
 
+
+_INLINE_DIRECTIVES = ("/save_to_memory", "/delete_from_memory")  # may follow text on the same line
+
+def is_directive_line(line):
+    """True for the reply lines that are memory directives rather than text for the user."""
+    low = line.lower().strip()
+    return low == "/used_memory" or any(d in low for d in _INLINE_DIRECTIVES) or low.isdigit()
+
+
+def has_directive_lines(text):
+    return any(is_directive_line(line) for line in text.splitlines())
+
+
+class DirectiveFilter:
+    """
+    Filter for a streamed reply. The current line is shown as it arrives up to where a
+    directive could start: a line that so far is blank, all digits or starts with "/" is
+    held whole, otherwise only from a "/" that is (the start of) an inline directive.
+    Once a line is complete, directive lines go to `on_directive`; the text before an
+    inline directive stays shown, the directive itself never is. Other lines are shown
+    in full. `text` collects everything that was shown (the reply as the user saw it).
+    """
+    def __init__(self, emit, on_directive):
+        self.emit = emit
+        self.on_directive = on_directive
+        self.line = ""
+        self.shown = 0   # characters of self.line already emitted
+        self.text = ""
+
+    def _show(self, text):
+        if text:
+            self.text += text
+            self.emit(text)
+
+    def _safe_end(self):
+        """How much of the unfinished line cannot belong to a directive."""
+        line = self.line
+        if not self.shown:
+            head = line.strip()
+            if not head or head.isdigit() or head.startswith("/"):
+                return 0
+        low = line.lower()
+        pos = low.find("/", self.shown)
+        while pos != -1:
+            rest = low[pos:]
+            if any(rest.startswith(d) or d.startswith(rest) for d in _INLINE_DIRECTIVES):
+                return pos
+            pos = low.find("/", pos + 1)
+        return len(line.rstrip("\r"))
+
+    def _finish_line(self, line):
+        line = line.rstrip("\r")
+        if is_directive_line(line):
+            low = line.lower()
+            cut = min([i for i in (low.find(d) for d in _INLINE_DIRECTIVES) if i != -1], default=0)
+            if line[:cut].strip():
+                self._show(line[self.shown:cut] + "\n")
+            self.on_directive(line)
+        else:
+            self._show(line[self.shown:] + "\n")
+        self.shown = 0
+
+    def feed(self, chunk):
+        self.line += chunk
+        while "\n" in self.line:
+            line, self.line = self.line.split("\n", 1)
+            self._finish_line(line)
+        end = self._safe_end()
+        if end > self.shown:
+            self._show(self.line[self.shown:end])
+            self.shown = end
+
+    def close(self):
+        if self.line:
+            self._finish_line(self.line)
+            self.line = ""
+
 # ============ CSV Processing ============
-def process_csv_upload(csv_path):
-    spinner = LoadingSpinner("Processing CSV file", Colors.INFO)
-    spinner.start()
-    
+def is_corpus_path(path):
+    return path.lower().endswith(".parquet") or os.path.isdir(path)
+
+def load_corpus(path, columns=CORPUS_COLUMNS):
+    """
+    Read the columnar corpus written by make_csv_file.py. `path` may be the
+    <name>_corpus directory or any part file inside it (the whole directory is read).
+    Only the requested columns are loaded.
+    """
+    if os.path.isfile(path) and os.path.basename(os.path.dirname(path)).endswith("_corpus"):
+        path = os.path.dirname(path)
+    return pd.read_parquet(path, columns=columns)
+
+def corpus_to_chats(df):
+    """Convert a corpus DataFrame into the chat dicts used everywhere else, column-wise."""
+    out = pd.DataFrame(index=df.index)
+    if "timestamp_ms" in df.columns:
+        ts = pd.to_datetime(df["timestamp_ms"], unit="ms", utc=True).dt.tz_convert("Asia/Kolkata")
+        text = ts.astype(str).str.replace(" ", "T", n=1, regex=False)
+        out["timestamp"] = text.where(ts.notna(), "").astype(object)  # a null timestamp is "", not NaN
+    else:
+        out["timestamp"] = ""
+    out["sender"] = df["sender"].astype(str) if "sender" in df.columns else ""
+    out["text"] = df["text"].fillna("").astype(str) if "text" in df.columns else ""
+    if "attachments" in df.columns:
+        out["attachments"] = df["attachments"].map(lambda a: ";".join(a) if a is not None else "")
+    else:
+        out["attachments"] = ""
+    return out.to_dict("records")
+
+def iter_csv_chunks(csv_path, chunksize=CSV_CHUNK_ROWS):
+    """
+    Read a chat CSV in chunks with explicit dtypes (sender as category) and yield each
+    chunk as a list of chat dicts, converted column-wise in one step. Only the current
+    chunk is read into memory; whether the chats stay bounded depends on the consumer
+    (iter_chat_file -> add_to_corpus writes each chunk out before the next is read).
+    """
+    header = pd.read_csv(csv_path, nrows=0).columns
+    timestamp_col = None
+    for c in ("timestamp_iso", "timestamp", "time", "date"):
+        if c in header:
+            timestamp_col = c
+            break
+    wanted = [c for c in (timestamp_col, "sender", "text", "attachments") if c and c in header]
+    dtypes = {c: "string" for c in wanted}
+    if "sender" in dtypes:
+        dtypes["sender"] = "category"
+    reader = pd.read_csv(csv_path, usecols=wanted, dtype=dtypes, keep_default_na=False,
+                         chunksize=chunksize)
+    for chunk in reader:
+        out = pd.DataFrame(index=chunk.index)
+        out["timestamp"] = chunk[timestamp_col].astype(str) if timestamp_col else ""
+        for col in ("sender", "text", "attachments"):
+            out[col] = chunk[col].astype(str) if col in chunk.columns else ""
+        yield out.to_dict("records")
+
+def iter_chat_file(csv_path, progress=None):
+    """
+    Read an Instagram CSV (or a parquet corpus from make_csv_file.py) without printing,
+    yielding the chats one chunk (list) at a time; consumers such as add_to_corpus keep
+    only one chunk in memory. progress(text), if given, is called after every chunk.
+    """
+    start = time.perf_counter()
+    if is_corpus_path(csv_path):
+        df = load_corpus(csv_path)  # columnar; converted to dicts a slice at a time
+        chunks = (corpus_to_chats(df.iloc[i:i + CSV_CHUNK_ROWS]) for i in range(0, len(df), CSV_CHUNK_ROWS))
+    else:
+        chunks = iter_csv_chunks(csv_path)
+    rows = 0
+    for records in chunks:
+        rows += len(records)
+        if progress:
+            rate = rows / max(time.perf_counter() - start, 1e-6)
+            progress(f"{rows:,} rows, {rate:,.0f} rows/s")
+        yield records
+
+# ============ Few-shot Retrieval ============
+# Imported chats are mined for (message -> owner's reply) pairs, the same heuristic
+# make_csv_file.py uses for <name>_fewshots.jsonl, and indexed on the message text.
+# Each turn the replies to the messages most similar to the user's input are put in the
+# prompt as examples of how the owner actually answers.
+def mine_fewshot_pairs(chats, max_gap_s=FEWSHOT_MAX_GAP_S):
+    """
+    Return (owner, prompts, responses) from a list of chat dicts, column-wise with pandas.
+    The owner is the most frequent sender; a pair is a message from someone else directly
+    followed by an owner message within max_gap_s. prompts are (sender, text) tuples.
+    """
+    df = pd.DataFrame.from_records(chats, columns=["timestamp", "sender", "text"])
+    df = df[~df["sender"].isin(LIVE_SENDERS)]
+    if df.empty:
+        return None, [], []
+    sender = df["sender"].fillna("").astype(str)
+    text = df["text"].fillna("").astype(str)
+    owner = sender.value_counts().idxmax()
+    ts = pd.to_datetime(df["timestamp"], errors="coerce", utc=True, format="ISO8601")
+    gap = (ts - ts.shift()).dt.total_seconds().abs()
+    prev_sender, prev_text = sender.shift(), text.shift()
+    mask = ((sender == owner) & prev_sender.notna() & (prev_sender != owner)
+            & (text.str.strip() != "") & (prev_text.fillna("").str.strip() != "")
+            & (gap.isna() | (gap <= max_gap_s)))
+    prompts = list(zip(prev_sender[mask], prev_text[mask]))
+    return owner, prompts, text[mask].tolist()
+
+
+class FewShotIndex:
+    """
+    Static BM25 index over the prompt side of the few-shot pairs, stored as numpy
+    postings (CSR: one slice of doc ids and precomputed BM25 term weights per term).
+    A query only touches the postings of its own terms, so it takes milliseconds
+    even for millions of pairs.
+    """
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, owner, prompts, responses):
+        self.owner = owner
+        self.prompts = prompts
+        self.responses = responses
+        n = len(prompts)
+        vocab = {}
+        term_ids = []
+        lengths = np.zeros(n, dtype=np.float32)
+        for i, (_, text) in enumerate(prompts):
+            toks = tokenize(text)
+            lengths[i] = len(toks)
+            term_ids.extend(vocab.setdefault(t, len(vocab)) for t in toks)
+        doc_ids = np.repeat(np.arange(n, dtype=np.int64), lengths.astype(np.int64))
+        keys, tf = np.unique(np.asarray(term_ids, dtype=np.int64) * max(n, 1) + doc_ids,
+                             return_counts=True)
+        terms = keys // max(n, 1)
+        self.vocab = vocab
+        self.docs = (keys % max(n, 1)).astype(np.int32)
+        self.offsets = np.searchsorted(terms, np.arange(len(vocab) + 1))
+        df = np.diff(self.offsets).astype(np.float32)
+        self.idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avg_len = float(lengths.mean()) if n and lengths.mean() else 1.0
+        tf = tf.astype(np.float32)
+        norm = tf + self.K1 * (1 - self.B + self.B * lengths[self.docs] / avg_len)
+        self.weights = (tf * (self.K1 + 1) / norm).astype(np.float32)
+
+    def __len__(self):
+        return len(self.prompts)
+
+    def save(self, npz_path, pairs_path, key):
+        """Write the arrays to npz and the pair texts to json-lines; `key` identifies the corpus."""
+        with open(pairs_path + ".tmp", "w", encoding="utf-8") as f:
+            for (sender, text), reply in zip(self.prompts, self.responses):
+                f.write(json.dumps([sender, text, reply], ensure_ascii=False) + "\n")
+        with open(npz_path + ".tmp", "wb") as f:
+            np.savez(f, key=np.asarray(key, dtype=np.int64), pairs=len(self.prompts),
+                     owner=str(self.owner or ""), vocab="\n".join(self.vocab),
+                     docs=self.docs, offsets=self.offsets, idf=self.idf, weights=self.weights)
+        os.replace(pairs_path + ".tmp", pairs_path)
+        os.replace(npz_path + ".tmp", npz_path)
+
+    @classmethod
+    def load(cls, npz_path, pairs_path, key):
+        """The cached index if it was built from the corpus identified by `key`, else None."""
+        if not (os.path.exists(npz_path) and os.path.exists(pairs_path)):
+            return None
+        try:
+            with np.load(npz_path) as z:
+                if tuple(z["key"].tolist()) != tuple(key):
+                    return None
+                with open(pairs_path, "r", encoding="utf-8") as f:
+                    rows = [json.loads(line) for line in f]
+                if len(rows) != int(z["pairs"]):
+                    return None
+                index = cls.__new__(cls)
+                index.owner = str(z["owner"]) or None
+                index.prompts = [(r[0], r[1]) for r in rows]
+                index.responses = [r[2] for r in rows]
+                vocab = str(z["vocab"])
+                index.vocab = {t: i for i, t in enumerate(vocab.split("\n"))} if vocab else {}
+                index.docs, index.offsets = z["docs"], z["offsets"]
+                index.idf, index.weights = z["idf"], z["weights"]
+        except (OSError, ValueError, KeyError):
+            return None
+        return index
+
+    def search(self, query, k):
+        """Indices of the k best matching pairs, best first."""
+        tids = {self.vocab[t] for t in tokenize(query) if t in self.vocab}
+        if not tids or k <= 0:
+            return []
+        scores = np.zeros(len(self.prompts), dtype=np.float32)
+        for tid in tids:
+            s, e = self.offsets[tid], self.offsets[tid + 1]
+            scores[self.docs[s:e]] += self.idf[tid] * self.weights[s:e]
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        return hits[np.argsort(-scores[hits], kind="stable")].tolist()
+
+    def examples(self, query, k=FEWSHOT_TOP_K, budget=FEWSHOT_TOKEN_BUDGET):
+        """Up to k (sender, message, reply) examples for `query` within ~budget tokens."""
+        out, used, seen = [], 0, set()
+        for i in self.search(query, k * 2):
+            sender, text = self.prompts[i]
+            reply = self.responses[i]
+            if reply in seen:
+                continue
+            cost = estimate_tokens(text) + estimate_tokens(reply)
+            if used + cost > budget:
+                continue
+            seen.add(reply)
+            out.append((sender, text, reply))
+            used += cost
+            if len(out) >= k:
+                break
+        return out
+
+
+FEWSHOT_INDEXES = {}   # username -> FewShotIndex (built in the background)
+
+def build_fewshot_index(username):
+    """
+    Load the user's few-shot index from its cache, or mine the corpus and rebuild it
+    (and the cache) when the corpus changed since the cache was written.
+    """
+    start = time.perf_counter()
+    key = corpus_key(username)
+    npz_path, pairs_path = get_fewshot_cache_paths(username)
+    index = FewShotIndex.load(npz_path, pairs_path, key)
+    if index is None:
+        index = FewShotIndex(*mine_fewshot_pairs(load_corpus_messages(username)))
+        try:
+            index.save(npz_path, pairs_path, key)
+        except OSError:
+            pass  # the in-memory index still works
+    if corpus_key(username) == key:  # an import may have grown the corpus meanwhile
+        FEWSHOT_INDEXES[username] = index
+    return index, time.perf_counter() - start
+
+def start_fewshot_index_build(username):
+    """Build the few-shot index in a daemon thread; turns before it is ready get no examples."""
+    FEWSHOT_INDEXES.pop(username, None)
+    t = threading.Thread(target=build_fewshot_index, args=(username,), daemon=True)
+    t.start()
+    return t
+
+# ============ Stylometry ============
+# Numeric style profile of the owner's messages, computed column-wise with pandas/NumPy
+# over the whole corpus: emoji and word frequencies, message length and burst size,
+# reply-gap percentiles, active hours and punctuation/casing rates. It is stored on the
+# user record as style_profile and put in the prompt next to the LLM analysis.
+STYLE_TIMEZONE = "Asia/Kolkata"
+ELONGATED_RE = "|".join(ch * 3 for ch in "abcdefghijklmnopqrstuvwxyz")  # "sooo", "yesss" (no backrefs in pyarrow regex)
+EMOJI_RE = re.compile("[\U0001F1E6-\U0001F1FF\U0001F300-\U0001FAFF\u2600-\u27BF\u2B50\u2B55\u203C\u2049]")
+
+def _percentiles(values, qs=(10, 50, 90)):
+    if not len(values):
+        return {}
+    return {f"p{q}": round(float(v), 1) for q, v in zip(qs, np.percentile(values, qs))}
+
+def _rate(mask):
+    return round(float(mask.mean()), 3) if len(mask) else 0.0
+
+def compute_style_profile(chats, owner=None):
+    """
+    Style statistics of `owner` (default: most frequent sender) in `chats` (chat dicts or
+    a DataFrame from load_corpus_frame), or None.
+    """
+    if isinstance(chats, pd.DataFrame):
+        df = chats
+    else:
+        df = pd.DataFrame.from_records(chats, columns=["timestamp", "sender", "text", "attachments"])
+    df = df[~df["sender"].isin(LIVE_SENDERS)].reset_index(drop=True)
+    if df.empty:
+        return None
+    sender = df["sender"].fillna("").astype(str)
+    owner = owner or sender.value_counts().idxmax()
+    mine = (sender == owner).to_numpy()
+    text = df["text"].fillna("").astype(str)
+    ts = pd.to_datetime(df["timestamp"], errors="coerce", utc=True, format="ISO8601")
+
+    own = text[mine]
+    own = own[own.str.strip() != ""]
+    chars = own.str.len()
+    words = own.str.count(r"\S+")
+    # one regex pass over the joined text is much faster than a per-row findall; done a
+    # slice of rows at a time so only that slice's tokens are ever held as Python strings
+    emoji_counts, word_counts = Counter(), Counter()
+    for i in range(0, len(own), CSV_CHUNK_ROWS):
+        joined = "\n".join(own.iloc[i:i + CSV_CHUNK_ROWS].tolist())
+        emoji_counts.update(EMOJI_RE.findall(joined))
+        word_counts.update(re.findall(r"[^\W\d_]+", joined.lower()))
+    for w in STOPWORDS:
+        word_counts.pop(w, None)
+    emojis = emoji_counts.most_common(15)
+    tokens = word_counts.most_common(30)
+
+    # reply gap: an owner message directly after someone else's
+    prev_sender = sender.shift()
+    replies = mine & prev_sender.notna().to_numpy() & (prev_sender != owner).to_numpy()
+    gaps = (ts - ts.shift()).dt.total_seconds()[replies].dropna()
+    gaps = gaps[(gaps >= 0) & (gaps <= FEWSHOT_MAX_GAP_S)]
+    # burst: consecutive owner messages count as one turn
+    runs = (sender != sender.shift()).cumsum()[mine].value_counts()
+
+    own_ts = ts[mine].dropna()
+    hours = np.bincount(own_ts.dt.tz_convert(STYLE_TIMEZONE).dt.hour.to_numpy(), minlength=24)
+    days = max((own_ts.max() - own_ts.min()).total_seconds() / 86400.0, 1.0) if len(own_ts) else None
+
+    stripped = own.str.rstrip()
+    letters = own.str.replace(r"[^A-Za-z]", "", regex=True)
+    has_letters = letters.str.len() >= 3
+    attachments = df["attachments"].fillna("").astype(str)[mine]
+    return {
+        "owner": owner,
+        "messages": int(mine.sum()),
+        "share_of_chat": round(float(mine.mean()), 3),
+        "messages_per_day": round(int(mine.sum()) / days, 1) if days else None,
+        "chars": {**_percentiles(chars), "mean": round(float(chars.mean()), 1) if len(chars) else 0},
+        "words": _percentiles(words),
+        "burst": {"mean": round(float(runs.mean()), 2) if len(runs) else 0, **_percentiles(runs, (90,))},
+        "reply_gap_s": _percentiles(gaps),
+        "hours": [round(float(h), 3) for h in hours / max(hours.sum(), 1)],
+        "rates": {
+            "question": _rate(stripped.str.endswith("?")),
+            "exclamation": _rate(own.str.contains("!", regex=False)),
+            "ends_with_period": _rate(stripped.str.endswith(".") & ~stripped.str.endswith("..")),
+            "ellipsis": _rate(own.str.contains(r"\.\.|…", regex=True)),
+            "all_lowercase": _rate(letters[has_letters] == letters[has_letters].str.lower()),
+            "starts_uppercase": _rate(own.str.match(r"\s*[A-Z]")),
+            "all_caps": _rate(letters[has_letters] == letters[has_letters].str.upper()),
+            "elongated_words": _rate(own.str.contains(ELONGATED_RE, case=False, regex=True)),
+            "with_emoji": _rate(own.str.contains(EMOJI_RE)),
+            "with_attachment": _rate(attachments.str.strip() != ""),
+        },
+        "top_emojis": [[e, int(n)] for e, n in emojis],
+        "top_words": [[w, int(n)] for w, n in tokens],
+        "computed_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+def _fmt_seconds(sec):
+    if sec is None:
+        return "?"
+    if sec < 90:
+        return f"{sec:.0f}s"
+    if sec < 5400:
+        return f"{sec / 60:.0f}min"
+    return f"{sec / 3600:.1f}h"
+
+def format_style_profile(p):
+    """Compact text form of a style profile for the prompt."""
+    if not p:
+        return "(no style profile yet)"
+    r = p["rates"]
+    top_hours = sorted(range(24), key=lambda h: -p["hours"][h])[:5]
+    gap = p.get("reply_gap_s") or {}
+    active = ("Most active hours (" + STYLE_TIMEZONE + "): "
+              + ", ".join(f"{h}h {p['hours'][h]:.0%}" for h in top_hours)) if any(p["hours"]) else None
+    lines = [
+        f"Owner: {p['owner']} ({p['messages']:,} messages, {p['share_of_chat']:.0%} of the chat"
+        + (f", ~{p['messages_per_day']}/day)" if p.get("messages_per_day") else ")"),
+        f"Message length: median {p['chars'].get('p50', 0):.0f} chars / {p['words'].get('p50', 0):.0f} words "
+        f"(p10 {p['chars'].get('p10', 0):.0f}, p90 {p['chars'].get('p90', 0):.0f} chars)",
+        f"Messages in a row: {p['burst']['mean']} on average (p90 {p['burst'].get('p90', 0):.0f})",
+        f"Reply time: median {_fmt_seconds(gap.get('p50'))} (p10 {_fmt_seconds(gap.get('p10'))}, "
+        f"p90 {_fmt_seconds(gap.get('p90'))})",
+        active,
+        "Rates per message: " + ", ".join(f"{k.replace('_', ' ')} {v:.0%}" for k, v in r.items()),
+        "Top emojis: " + (" ".join(f"{e}×{n}" for e, n in p["top_emojis"]) or "none"),
+        "Top words: " + ", ".join(f"{w} {n}" for w, n in p["top_words"]),
+    ]
+    return "\n".join(l for l in lines if l)
+
+def refresh_style_profile(username, chats=None):
+    """Recompute the user's style profile from their corpus and store it on the user record."""
+    if chats is None:
+        chats = load_corpus_frame([get_user_corpus_path(username)])
+    profile = compute_style_profile(chats)
+    if profile is not None:
+        update_user(username, style_profile=profile)
+    return profile
+
+# ============ Style Analysis ============
+# Map-reduce over the whole imported corpus: every message goes into one of the
+# token-bounded chunks, the chunks are analyzed by at most ANALYSIS_WORKERS concurrent
+# Gemini calls and the partial analyses are merged. Partials that do not fit one merge
+# call (ANALYSIS_REDUCE_TOKENS) are merged in consecutive groups first, round by round.
+# Chunk and group boundaries are cut greedily from the start of the corpus and a prompt
+# depends only on its own messages, so when the corpus grows at the end only the last
+# chunk, the new ones and the merges above them are sent again; the rest come from the
+# response cache. If any call fails the analysis fails with the count, rather than
+# being merged from a subset; the calls that succeeded are cached for the next run.
+# Counts, lengths, timing and punctuation rates are measured locally (see Stylometry),
+# so the LLM is only asked for what needs reading comprehension.
+ANALYSIS_POINTS = """- A short natural-language summary of overall tone & attitude.
+- Typical vocabulary choices (swearing, slang, formality) and which emojis are used for what.
+- Use of attachments / media (what for).
+- Typical reply structure (one-liners, bursts of short messages, questions back, ...).
+- A small list of example phrases or reply patterns the user uses.
+- Identification of context:
+    * Determine when the user is speaking to the AI directly.
+    * Determine when the user is asking for a reply to someone else.
+- Lessons or knowledge the user is teaching that could be used for future replies.
+- A short "Instructions for assistant" section describing how you (the AI) should answer to mimic this user.
+- What kind of language the user uses 
+- Tone of the language 
+- Even spelling patterns
+Do not count frequencies, message lengths or reply times: those are measured separately."""
+
+
+class AnalysisCancelled(Exception):
+    pass
+
+
+class AnalysisFailed(Exception):
+    pass
+
+
+def detect_owner(chats):
+    """Most frequent sender of the imported chats (the person being mimicked)."""
+    senders = pd.Series([m.get("sender") for m in chats if m.get("sender") not in LIVE_SENDERS], dtype="object")
+    return senders.value_counts().idxmax() if len(senders) else None
+
+def chunk_chats(chats, max_tokens=ANALYSIS_CHUNK_TOKENS):
+    """
+    Yield chats in chunks of at most ~max_tokens as (first timestamp, last timestamp, text).
+    Boundaries are cut greedily from the first message, so appending messages never moves
+    an earlier boundary. `chats` may be a stream (iter_corpus_messages); only the chunk
+    being filled is held.
+    """
+    lines, used, first_ts, last_ts = [], 0, "", ""
+    for m in chats:
+        text = m.get("text")
+        if not text or m.get("sender") in LIVE_SENDERS:
+            continue
+        line = f"{m.get('sender', 'Unknown')}: {text}"
+        cost = estimate_tokens(line)
+        if lines and used + cost > max_tokens:
+            yield first_ts, last_ts, "\n".join(lines)
+            lines, used = [], 0
+        if not lines:
+            first_ts = m.get("timestamp") or ""
+        lines.append(line)
+        used += cost
+        last_ts = m.get("timestamp") or last_ts
+    if lines:
+        yield first_ts, last_ts, "\n".join(lines)
+
+def group_partials(partials, max_tokens=ANALYSIS_REDUCE_TOKENS):
+    """
+    Cut partial analyses (oldest first) into consecutive groups of ~max_tokens for one
+    merge round, greedily from the first, with at least two per group so a round
+    always shrinks the list.
+    """
+    groups, used = [], 0
+    for p in partials:
+        cost = estimate_tokens(p)
+        if groups and (len(groups[-1]) < 2 or used + cost <= max_tokens):
+            groups[-1].append(p)
+            used += cost
+        else:
+            groups.append([p])
+            used = cost
+    if len(groups) > 1 and len(groups[-1]) < 2:
+        groups[-2].extend(groups.pop())
+    return groups
+
+def map_analysis_prompt(chunk, owner, starting_command):
+    # only the chunk itself goes in (no position, no slice count, no measured profile),
+    # so a chunk prompt stays identical (and cached) when the corpus grows
+    first_ts, last_ts, text = chunk
+    span = f" {first_ts[:10]} to {last_ts[:10]}" if first_ts and last_ts else ""
+    return f"""
+You are an assistant whose job is to analyze the style, tone, language, and reply patterns of the target user,
+based on one slice of their chat history that follows. The user asked: "{starting_command}"
+The target user is "{owner}". This slice covers{span or " an unknown date range"}; other slices are analyzed separately
+and merged later, so describe only what this slice shows and give concrete counts and examples.
+
+Please output a clear structured summary that includes:
+{ANALYSIS_POINTS}
+
+Here is the chat slice:
+{text}
+
+Be concise but thorough.
+"""
+
+def reduce_analysis_prompt(partials, owner, starting_command, profile=None):
+    # merge rounds below the last one go without the profile: it changes with every
+    # upload and would keep their prompts out of the cache
+    joined = "\n\n".join(f"----- Partial analysis {i} -----\n{p.strip()}" for i, p in enumerate(partials, 1))
+    stats = (f"\nMeasured statistics of the whole history (already known to the assistant, use them, "
+             f"do not restate them):\n{format_style_profile(profile)}\n") if profile else ""
+    return f"""
+You are an assistant whose job is to analyze the style, tone, language, and reply patterns of the target user.
+The user asked: "{starting_command}"
+The chat history of "{owner}" (or a consecutive part of it) was split into {len(partials)} slices, each analyzed
+separately (below, oldest first). Merge them into ONE analysis of the user: keep the patterns that recur across
+slices, note how the style changed over time where it clearly did, and drop one-off details.
+{stats}
+Please output a clear structured summary that includes:
+{ANALYSIS_POINTS}
+
+{joined}
+
+Be concise but thorough.
+"""
+
+def merge_analysis_prompt(previous, partials, owner, starting_command, new_count, profile=None):
+    joined = "\n\n".join(f"----- New messages, partial analysis {i} -----\n{p.strip()}"
+                          for i, p in enumerate(partials, 1))
+    return f"""
+You are an assistant whose job is to keep the analysis of the style, tone, language, and reply patterns of the
+target user "{owner}" up to date. The user asked: "{starting_command}"
+Below is the EXISTING analysis of their earlier chats, followed by the analysis of {new_count} newly imported
+messages. Produce the UPDATED analysis: keep everything from the existing one that the new messages do not
+contradict, add new patterns, phrases and knowledge, and note style changes the new messages clearly show.
+
+Please output a clear structured summary that includes:
+{ANALYSIS_POINTS}
+
+Measured statistics of the whole history (already known to the assistant, use them, do not restate them):
+{format_style_profile(profile)}
+
+----- Existing analysis -----
+{previous.strip()}
+
+{joined}
+
+Be concise but thorough.
+"""
+
+def run_style_analysis(client, chats, starting_command, spinner=None, cancel=None, profile=None, previous=None):
+    """
+    Map-reduce style analysis of `chats` (see the section comment); `chats` may be a
+    stream when `profile` names the owner. Progress is shown on
+    `spinner`; setting `cancel` (threading.Event) or Ctrl+C stops it with AnalysisCancelled.
+    With `previous` (an existing analysis), `chats` is only the new messages and the
+    last merge folds their analysis into it.
+    Returns the analysis text, or None if there is nothing to analyze; raises
+    AnalysisFailed (with how many calls failed) if any chunk or merge call fails.
+    """
+    cancel = cancel or threading.Event()
+    owner = (profile or {}).get("owner")
+    if not owner:
+        chats = list(chats)
+        owner = detect_owner(chats)
+    n_chats = 0
+
+    def counted(stream):
+        nonlocal n_chats
+        for m in stream:
+            n_chats += 1
+            yield m
+
+    label = spinner.message if spinner else ""
+
+    def progress(text):
+        if spinner:
+            spinner.message = f"{label} ({text})"
+
+    def analyze(prompt):
+        if cancel.is_set():
+            raise AnalysisCancelled()
+        info = {}
+        text = generate_response_stream(client, "gemini-2.5-flash", "", prompt, info=info,
+                                        deadline_s=ANALYSIS_DEADLINE_S, use_cache=True, quiet=True,
+                                        read_timeout_s=ANALYSIS_READ_TIMEOUT_S, cancel=cancel)
+        return None if info.get("error") else text
+
+    started = time.perf_counter()
+    slots = threading.BoundedSemaphore(ANALYSIS_WORKERS)
+
+    def submit(prompt):
+        # daemon threads rather than a ThreadPoolExecutor, whose workers the interpreter
+        # joins at exit: an analysis still running must not hold up quitting the app
+        fut = Future()
+
+        def run():
+            with slots:
+                if not fut.set_running_or_notify_cancel():
+                    return
+                try:
+                    fut.set_result(analyze(prompt))
+                except BaseException as e:
+                    fut.set_exception(e)
+
+        threading.Thread(target=run, daemon=True).start()
+        return fut
+
+    def until_done(pending):
+        # poll, so a cancel takes effect at once instead of after the slowest request
+        while pending:
+            finished, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            if cancel.is_set():
+                raise AnalysisCancelled()
+            yield from finished
+
+    def run_all(prompts, what):
+        # prompts may be a generator: only a few more than ANALYSIS_WORKERS are built
+        # ahead, so a long history is never held as prompts all at once
+        results, futures, total = [], {}, None
+        prompts = iter(prompts)
+        while True:
+            while total is None and len(futures) < 2 * ANALYSIS_WORKERS:
+                prompt = next(prompts, None)
+                if prompt is None:
+                    total = len(results)
+                    break
+                futures[submit(prompt)] = len(results)
+                results.append(None)
+            if not futures:
+                break
+            fut = next(until_done(set(futures)))
+            results[futures.pop(fut)] = fut.result()
+            done = len(results) - len(futures)
+            progress(f"{what} {done}/{total if total is not None else str(len(results)) + '+'}, "
+                     f"{time.perf_counter() - started:.0f}s")
+        failed = sum(r is None for r in results)
+        if failed:
+            raise AnalysisFailed(f"{failed} of {len(results)} {what} calls failed; "
+                                 "running it again resends only those (the rest are cached)")
+        return results
+
     try:
-        df = pd.read_csv(csv_path)
-        chats = []
-        timestamp_col = None
-        for c in ("timestamp_iso", "timestamp", "time", "date"):
-            if c in df.columns:
-                timestamp_col = c
+        partials = run_all((map_analysis_prompt(c, owner, starting_command)
+                            for c in chunk_chats(counted(chats))), "chunk")
+        if not partials:
+            return None
+        # merge consecutive groups until the rest fits one call
+        while len(partials) > 1:
+            groups = group_partials(partials)
+            if len(groups) == 1:
                 break
-        for _, row in df.iterrows():
-            ts = str(row.get(timestamp_col, "")) if timestamp_col else ""
-            sender = row.get("sender", "") if "sender" in row.index else ""
-            text = row.get("text", "") if "text" in row.index else ""
-            attachments = row.get("attachments", "") if "attachments" in row.index else ""
-            chats.append({
-                "timestamp": ts,
-                "sender": str(sender),
-                "text": str(text),
-                "attachments": str(attachments),
-            })
-        spinner.stop()
-        print_success(f"Loaded {len(chats)} messages from CSV")
-        return chats
-    except Exception as e:
+            partials = run_all((reduce_analysis_prompt(g, owner, starting_command) for g in groups), "merge")
+        if previous:
+            prompt = merge_analysis_prompt(previous, partials, owner, starting_command, n_chats, profile)
+        elif len(partials) == 1:
+            return partials[0]
+        else:
+            prompt = reduce_analysis_prompt(partials, owner, starting_command, profile)
+        progress(f"merging {len(partials)} partial analyses")
+        return run_all([prompt], "final merge")[0]
+    except (KeyboardInterrupt, AnalysisCancelled):
+        cancel.set()  # queued calls stop before sending, running ones abandon their request
+        raise AnalysisCancelled()
+
+# ============ Background Jobs ============
+# Imports and style analysis take from seconds to minutes, so they run on a worker thread
+# while the chat goes on with the current analysis. A job only writes the user record at
+# the very end, in one update_user call, so a turn sees either the old analysis or the
+# new one. The chat loop prints finished jobs at the start of the next turn; /jobs lists them.
+
+class Job:
+    def __init__(self, job_id, name, fn):
+        self.id = job_id
+        self.name = name
+        self.fn = fn                      # fn(job); may set job.message / job.result
+        self.status = "queued"            # queued, running, done, failed, cancelled
+        self.message = ""                 # progress text (run_style_analysis writes here too)
+        self.result = ""
+        self.error = ""
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel = threading.Event()
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def check_cancelled(self):
+        if self.cancel.is_set():
+            raise AnalysisCancelled()
+
+
+class JobManager:
+    """
+    Runs jobs one at a time, in submission order, on a daemon thread (the jobs themselves
+    fan out where it pays, e.g. run_style_analysis). Finished jobs are kept as notices
+    for the chat loop to print.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.notices = []
+        self.thread = None
+
+    def submit(self, name, fn):
+        with self.lock:
+            job = Job(len(self.jobs) + 1, name, fn)
+            self.jobs.append(job)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        self.queue.put(job)
+        return job
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs)
+
+    def active(self):
+        return [j for j in self.list() if j.status in ("queued", "running")]
+
+    def wait(self, timeout=None):
+        """Block until no job is queued or running (or timeout). Returns whether that is the case."""
+        end = None if timeout is None else time.time() + timeout
+        while self.active():
+            if end is not None and time.time() >= end:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def shutdown(self, timeout=5.0):
+        """At exit: cancel what is left and give it a moment to clean up (drop pending deltas)."""
+        for job in self.active():
+            job.cancel.set()
+        self.wait(timeout)
+
+    def cancel(self, job_id):
+        """Ask a queued or running job to stop. Returns False if there is nothing to cancel."""
+        with self.lock:
+            job = next((j for j in self.jobs if j.id == job_id), None)
+        if job is None or job.status not in ("queued", "running"):
+            return False
+        job.cancel.set()
+        return True
+
+    def take_notices(self):
+        with self.lock:
+            notices, self.notices = self.notices, []
+        return notices
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            job.started = time.time()
+            if job.cancel.is_set():
+                job.status = "cancelled"
+            else:
+                job.status = "running"
+                try:
+                    job.fn(job)
+                    job.status = "done"
+                except AnalysisCancelled:
+                    job.status = "cancelled"
+                except Exception as e:
+                    job.status = "failed"
+                    job.error = str(e) or type(e).__name__
+            job.finished = time.time()
+            with self.lock:
+                self.notices.append(job)
+
+
+JOBS = JobManager()
+atexit.register(JOBS.shutdown)
+
+
+def import_chats_job(username, csv_path=None, announce=False):
+    """
+    Job body for signup and /upload_new_chat_data: read the file, find the messages that
+    are not in the corpus yet, analyze them and swap in the analysis. With an analysis to
+    merge into, only the new messages are analyzed and they reach the corpus only after
+    the merged analysis is saved (see Chat Corpus Store). Without one they are added
+    right away and the whole corpus is analyzed; that also covers an earlier import whose
+    analysis never finished. Without csv_path nothing is read: only that whole-corpus
+    analysis runs, if there is no analysis yet.
+    With announce the analysis is also added to the chat log (signup).
+    """
+    def run(job):
+        recover_corpus_delta(username)
+
+        def chunks():
+            for records in iter_chat_file(csv_path, lambda text: setattr(job, "message", f"reading file ({text})")):
+                job.check_cancelled()
+                yield records
+
+        rec = get_user(username) or {}
+        previous = rec.get("analysis")
+        if previous and previous.startswith("ERROR:"):
+            previous = None
+        corpus_path = get_user_corpus_path(username)
+        delta_path = get_pending_delta_paths(username)[0]
+        try:
+            job.message = "reading file"
+            if csv_path is None:
+                read = new = 0
+            elif previous:
+                read, new = stage_corpus_delta(username, chunks())
+            else:
+                read, new = add_to_corpus(username, chunks())
+                start_fewshot_index_build(username)
+            job.result = f"{read} messages read, {new} new" if csv_path else "whole corpus"
+            if previous and not new:
+                discard_corpus_delta(username)
+                return
+
+            # everything below streams from disk: the profile from a columnar frame, the
+            # analysis from a message iterator
+            job.message = "measuring style"
+            profile = compute_style_profile(load_corpus_frame([corpus_path, delta_path] if previous else [corpus_path]))
+            job.check_cancelled()
+            job.message = "analyzing"
+            analysis = run_style_analysis(get_genai_client(), iter_corpus_messages(delta_path if previous else corpus_path),
+                                          rec.get("starting_command") or "", job, job.cancel,
+                                          profile=profile, previous=previous)
+            if not analysis:
+                raise RuntimeError("Gemini returned no analysis")
+            job.check_cancelled()
+        except BaseException:
+            discard_corpus_delta(username)  # the messages stay new for the next upload
+            raise
+
+        # the analysis, the profile and (with a delta) the token that lets
+        # recover_corpus_delta finish the commit after a crash, in one update
+        update_user(username, analysis=analysis, style_profile=profile,
+                    analysis_generated_at=datetime.now(timezone.utc).isoformat(),
+                    corpus_delta=pending_delta_token(username) if previous else None)
+        if announce:
+            append_chat_history(username, [{"sender": "AI", "text": analysis, "meta": {"analysis_result": True}}])
+        flush_user_store()
+        if previous and commit_corpus_delta(username):
+            start_fewshot_index_build(username)
+        job.result += ", new analysis in use"
+    return run
+
+
+def print_job_notices():
+    for job in JOBS.take_notices():
+        if job.status == "done":
+            print_success(f"Job #{job.id} ({job.name}) finished in {job.elapsed():.0f}s: {job.result}\n")
+        elif job.status == "cancelled":
+            print_warning(f"Job #{job.id} ({job.name}) cancelled; keeping the previous analysis.\n")
+        else:
+            print_error(f"Job #{job.id} ({job.name}) failed after {job.elapsed():.0f}s: {job.error}\n")
+
+
+def print_jobs(jobs=None):
+    jobs = JOBS.list() if jobs is None else jobs
+    if not jobs:
+        print_info("No background jobs in this session.\n")
+        return
+    print_info("Background jobs:")
+    for job in jobs:
+        detail = job.error if job.status == "failed" else (job.message if job.status == "running" else job.result)
+        print(f"  #{job.id:<3} {job.name:<14} {job.status:<10} {job.elapsed():6.0f}s  {Colors.DIM}{detail}{Colors.RESET}")
+    print()
+
+def confirm_exit_with_jobs():
+    """
+    Before leaving the chat: if imports or analyses are still running, list them and let
+    the user wait for them, cancel them or keep chatting. Returns whether to exit.
+    """
+    active = JOBS.active()
+    if not active:
+        return True
+    print_warning("Background jobs are still running; exiting now would stop them:")
+    print_jobs(active)
+    choice = input(f"{Colors.PRIMARY}[w]ait for them, [c]ancel them, or keep [chatting]: {Colors.RESET}").strip().lower()
+    if choice in ("c", "cancel"):
+        JOBS.shutdown(timeout=30)
+    elif choice in ("w", "wait"):
+        spinner = LoadingSpinner("Waiting for background jobs (Ctrl+C cancels them)", Colors.INFO)
+        spinner.start()
+        try:
+            while JOBS.active():
+                job = JOBS.active()[0]
+                spinner.message = f"Waiting for job #{job.id} ({job.name}): {job.message or job.status} (Ctrl+C cancels)"
+                time.sleep(0.2)
+        except KeyboardInterrupt:
+            JOBS.shutdown(timeout=30)
         spinner.stop()
-        print_error(f"Failed to read CSV: {e}")
-        return []
+    else:
+        return False
+    print_job_notices()
+    return True
 
 # ============ File Selector ============
 def select_csv_file():
@@ -353,8 +2632,8 @@ def select_csv_file():
     root = tk.Tk()
     root.withdraw()
     file_path = filedialog.askopenfilename(
-        title="Select Instagram CSV",
-        filetypes=[("CSV files", "*.csv"), ("All files", "*.*")]
+        title="Select Instagram CSV or chat corpus",
+        filetypes=[("CSV files", "*.csv"), ("Chat corpus (parquet)", "*.parquet"), ("All files", "*.*")]
     )
     try:
         root.destroy()
@@ -394,33 +2673,17 @@ def add_learning(username, fact, expiry=None):
     Save a learning fact to user's memory with a serial number `sno`.
     Returns the assigned sno (int) on success, or False on duplicate/error.
     expiry: string (ISO format) or None
+    The change is written on the next flush_user_store().
     """
-    users = load_users()
-    if username not in users:
-        users[username] = {}
-
-    if "learning" not in users[username]:
-        users[username]["learning"] = []
-
     incoming_text = fact.strip()
-    existing_texts = [
-        (lf["text"] if isinstance(lf, dict) else str(lf)).strip().lower()
-        for lf in users[username]["learning"]
-    ]
-
-    if incoming_text.lower() in existing_texts:
+    if USER_STORE.find_memory(username, incoming_text) is not None:
         print_warning(f"Memory already exists: {incoming_text}")
         return False
 
-    # assign sno
-    next_sno = _get_next_sno_for_user(users[username])
-    fact_entry = {"sno": next_sno, "text": incoming_text}
-    if expiry is not None:
-        fact_entry["expiry"] = expiry  # ISO string
-
-    users[username]["learning"].append(fact_entry)
-    save_users(users)
-    return next_sno
+    # assign sno (monotonic high-water mark, never reused)
+    sno = USER_STORE.add_memory(username, incoming_text, expiry)
+    EXPIRY_REAPER.schedule(username, sno, expiry_to_ts(expiry))
+    return sno
 
 
 def forget_learning(username, fact_substring_or_sno: str):
@@ -428,66 +2691,162 @@ def forget_learning(username, fact_substring_or_sno: str):
     Delete learning by sno (exact integer) or by substring match.
     fact_substring_or_sno may be '3' (sno) or 'gym' (substring).
     """
-    users = load_users()
-    if username not in users:
-        return False
-
-    facts = users[username].get("learning", [])
-    if not facts:
-        return False
-
     target = fact_substring_or_sno.strip().lower()
-    new_facts = []
-    deleted = []
 
     # if target is integer -> delete by sno
     if target.isdigit():
-        sno_target = int(target)
-        for f in facts:
-            f_text = f["text"] if isinstance(f, dict) else str(f)
-            f_sno = f.get("sno") if isinstance(f, dict) else None
-            if f_sno == sno_target:
-                deleted.append(f_text)
-            else:
-                new_facts.append(f)
+        snos = [int(target)]
     else:
-        # substring match
-        for f in facts:
-            f_text = f["text"] if isinstance(f, dict) else str(f)
-            if target in f_text.lower():
-                deleted.append(f_text)
-            else:
-                new_facts.append(f)
+        # substring match through the trigram index
+        snos = [f["sno"] for f in USER_STORE.search_memories(username, target)]
 
-    users[username]["learning"] = new_facts
-    save_users(users)
-    return deleted  # list of deleted texts (empty if nothing)
+    deleted = USER_STORE.delete_memories(username, snos)
+    return [f["text"] for f in deleted]  # list of deleted texts (empty if nothing)
+
+def parse_memory_directive(line):
+    """
+    Parse one directive line of an AI reply into an op dict, or None if it is not one:
+    {"op": "used"}, {"op": "save", "text", "time"} or {"op": "delete", "target"}.
+    """
+    stripped = line.strip()
+    low = stripped.lower()
+    if low == "/used_memory":
+        return {"op": "used", "directive": stripped}
+    if "/save_to_memory" in low:
+        payload = stripped[low.find("/save_to_memory") + len("/save_to_memory"):].strip()
+        fact_text, sep, time_str = payload.partition("/for")
+        return {"op": "save", "directive": stripped, "text": fact_text.strip(),
+                "time": time_str.strip() if sep else None}
+    if "/delete_from_memory" in low:
+        target = stripped[low.find("/delete_from_memory") + len("/delete_from_memory"):].strip()
+        return {"op": "delete", "directive": stripped, "target": target}
+    if low.isdigit():
+        # numeric-only line: "delete memory #n"
+        return {"op": "delete", "directive": stripped, "target": low}
+    return None
+
+def apply_memory_directives(username, ops):
+    """
+    Validate all directives of one reply together and apply them as a single batch:
+    saves are checked for empty text, bad /for times and duplicates (stored or earlier in
+    the batch), deletes for unknown SNos. Everything is written by one flush.
+    Returns one report dict per directive: {"directive", "op", "status", "detail"} with
+    status "saved", "deleted", "used", "duplicate", "invalid" or "not_found".
+    """
+    report = []
+    schedules = []
+    now = datetime.now()
+    with USER_STORE.lock:
+        batch_texts = set()
+        batch_deleted = set()
+        for op in ops:
+            entry = {"directive": op["directive"], "op": op["op"], "status": "used", "detail": ""}
+            report.append(entry)
+            if op["op"] == "save":
+                text = op["text"]
+                expiry = None
+                if not text:
+                    entry.update(status="invalid", detail="empty memory text")
+                    continue
+                if op["time"] is not None:
+                    delta = parse_time_string(op["time"])
+                    if not delta:
+                        entry.update(status="invalid", detail=f"invalid time format '{op['time']}'")
+                        continue
+                    expiry = (now + delta).isoformat()
+                key = normalize_memory_text(text)
+                if key in batch_texts:
+                    entry.update(status="duplicate", detail=f"saved twice in this reply: {text}")
+                    continue
+                if USER_STORE.find_memory(username, text) is not None:
+                    entry.update(status="duplicate", detail=f"already in memory: {text}")
+                    continue
+                batch_texts.add(key)
+                sno = USER_STORE.add_memory(username, text, expiry)
+                schedules.append((sno, expiry_to_ts(expiry)))
+                detail = f"SNo {sno}: {text}" + (f" (expires in {op['time']})" if expiry else " (permanent)")
+                entry.update(status="saved", detail=detail)
+            elif op["op"] == "delete":
+                target = op["target"].lower()
+                if not target:
+                    entry.update(status="invalid", detail="nothing to delete")
+                    continue
+                if target.isdigit():
+                    if int(target) in batch_deleted:
+                        entry.update(status="duplicate", detail=f"SNo {target} already deleted in this reply")
+                        continue
+                    if int(target) not in USER_STORE.get_memories(username):
+                        entry.update(status="not_found", detail=f"SNo {target} does not exist")
+                        continue
+                    snos = [int(target)]
+                else:
+                    snos = [m["sno"] for m in USER_STORE.search_memories(username, target)]
+                deleted = USER_STORE.delete_memories(username, snos)
+                batch_deleted.update(m["sno"] for m in deleted)
+                if deleted:
+                    entry.update(status="deleted", detail=", ".join(f"SNo {m['sno']}: {m['text']}" for m in deleted))
+                else:
+                    entry.update(status="not_found", detail=f"no memory matches '{op['target']}'")
+    for sno, expiry_ts in schedules:
+        EXPIRY_REAPER.schedule(username, sno, expiry_ts)
+    flush_user_store()
+    return report
+
+def search_learning(username, query, limit=MEMORY_SEARCH_LIMIT):
+    """Memories containing `query` (case-insensitive), at most `limit`."""
+    return [dict(m) for m in USER_STORE.search_memories(username, query.strip(), limit)]
+
+def format_prompt_memory(lf):
+    expiry = lf.get("expiry")
+    expiry_str = f" (expires {expiry})" if expiry else " (permanent)"
+    pinned_str = " [pinned]" if lf.get("pinned") else ""
+    return f"SNo {lf.get('sno')}: {lf.get('text', '')}{expiry_str}{pinned_str}"
+
+def select_memories_for_prompt(username, query, include_all=None):
+    """
+    Pick the memories to put in the prompt: every pinned memory, then the most relevant
+    ones for `query` (BM25, at most MEMORY_TOP_K) while they fit in MEMORY_TOKEN_BUDGET.
+    With include_all (default MEMORY_INCLUDE_ALL) every memory is sent.
+    Returns (selected memories in SNo order, tokens of all memories, tokens of the selection).
+    """
+    if include_all is None:
+        include_all = MEMORY_INCLUDE_ALL
+    mems = USER_STORE.get_memories(username)
+    all_tokens = sum(estimate_tokens(format_prompt_memory(m)) for m in mems.values())
+    if include_all:
+        return [dict(m) for m in mems.values()], all_tokens, all_tokens
+    chosen = {}
+    used = 0
+    ranked = USER_STORE.rank_memories(username, query, MEMORY_TOP_K)
+    for m in [m for m in mems.values() if m.get("pinned")] + ranked:
+        if m["sno"] in chosen:
+            continue
+        cost = estimate_tokens(format_prompt_memory(m))
+        if used + cost > MEMORY_TOKEN_BUDGET and not m.get("pinned"):
+            continue
+        chosen[m["sno"]] = dict(m)
+        used += cost
+    return [chosen[sno] for sno in sorted(chosen)], all_tokens, used
+
+def format_memory_line(lf):
+    expiry = lf.get("expiry")
+    expiry_str = f" (expires {expiry})" if expiry else " (permanent)"
+    return f"  SNo {lf.get('sno')}. {lf.get('text', '')}{expiry_str}"
 
 def migrate_existing_memories_add_sno(username):
     """
-    Optional: convert older memory entries that were plain strings into dicts
-    and ensure each memory has an `sno`. Safe to call multiple times.
+    Rebuild a user's memory indexes (text, trigram, BM25) from the database and make
+    sure the SNo counter is past every stored SNo. Memories are never removed.
+    Safe to call multiple times. Returns False if the user does not exist.
     """
-    users = load_users()
-    if username not in users:
+    if not user_exists(username):
         return False
-    rec = users[username]
-    facts = rec.get("learning", [])
-    migrated = []
-    next_sno = _get_next_sno_for_user(rec)
-    for f in facts:
-        if isinstance(f, dict):
-            # ensure sno exists
-            if not f.get("sno"):
-                f["sno"] = next_sno
-                next_sno += 1
-            migrated.append(f)
-        else:
-            # string -> dict
-            migrated.append({"sno": next_sno, "text": str(f)})
-            next_sno += 1
-    users[username]["learning"] = migrated
-    save_users(users)
+    with USER_STORE.lock:
+        flush_user_store()
+        USER_STORE.memories.pop(username, None)  # the next read rebuilds the indexes
+        USER_STORE.get_memories(username)
+        USER_STORE._queue(username, _BUMP_LAST_SNO_SQL, (USER_STORE.last_sno[username], username))
+    flush_user_store()
     return True
 
 
@@ -501,26 +2860,23 @@ def login():
 
     for attempt in range(3):
         print_section_header(f"USER LOGIN ({3-attempt} left)")
-        users = load_users()
         username = input(f"{Colors.PRIMARY}Enter username: {Colors.RESET}").strip()
 
         if not username:
             print_error("Username cannot be empty.")
             continue
 
-        if username not in users:
+        if not user_exists(username):
             print_error("User not found. Please try again.")
             continue
 
         print_success(f"Welcome back, {username}!")
         return username
 
-    users = load_users()
-
     if not username:
         return None
 
-    if username not in users:
+    if not user_exists(username):
         return None
 
     print_success(f"Welcome back, {username}!")
@@ -537,13 +2893,12 @@ def signup():
     """
     print_section_header("NEW USER SIGNUP (No password required)")
 
-    users = load_users()
     username = input(f"{Colors.PRIMARY}Enter username: {Colors.RESET}").strip()
 
     if not username:
         print_error("Username cannot be empty.")
         return None
-    if username in users:
+    if user_exists(username):
         print_error("Username already exists. Please login instead.")
         return None
 
@@ -561,91 +2916,20 @@ def signup():
     if not starting_command:
         starting_command = "Analyze my chat style, tone, language, and reply patterns."
 
-    chat_data = process_csv_upload(csv_path)
-    save_chat_history(username, chat_data)
-
-    spinner = LoadingSpinner("Creating account", Colors.SUCCESS)
-    spinner.start()
-    time.sleep(1)
-
-    # Create user record (no password fields)
-    users[username] = {
-        "created_at": datetime.now(timezone.utc).isoformat(),
-        "starting_command": starting_command,
-        "analysis": None,
-        "learning": []
-    }
-    save_users(users)
-    spinner.stop()
-
-    print_success(f"Signup complete! {len(chat_data)} messages loaded.")
-
-    # Run AI analysis on the uploaded CSV preview
-    print_section_header("AI ANALYSIS IN PROGRESS")
-    client = get_genai_client()
-
-    preview_msgs = chat_data[-CSV_PREVIEW_MSGS:] if chat_data else []
-    context_preview = "\n".join(f"{m['sender']}: {m['text']}" for m in preview_msgs if m.get("text"))
-
-    if not context_preview:
-        context_preview = "(no previewable messages found in CSV)"
-
-    analysis_prompt = f"""
-You are an assistant whose job is to analyze the style, tone, language, and reply patterns of the target user,
-based on the chat preview that follows. The user asked: "{starting_command}"
-
-Please output a clear structured summary that includes:
-- A short natural-language summary of overall tone & attitude.
-- Typical vocabulary choices (swearing, slang, emojis, punctuation, formality).
-- Reply rhythm / timing patterns you can infer.
-- Use of attachments / media.
-- Typical reply length and structure.
-- A small list of example phrases or reply patterns the user uses.
-- Identification of context:
-    * Determine when the user is speaking to the AI directly.
-    * Determine when the user is asking for a reply to someone else.
-- Lessons or knowledge the user is teaching that could be used for future replies.
-- A short "Instructions for assistant" section describing how you (the AI) should answer to mimic this user.
-- What kind of language the user uses 
-- Tone of the language 
-- Frequency of the messages
-- Frequency of each slangs, emojis, swearing, punctuation, formality etc 
-- Even spelling patterns
-
-Here is the chat preview (most recent messages, up to {CSV_PREVIEW_MSGS} lines):
-{context_preview}
-
-Be concise but thorough.
-"""
-
-    spinner = LoadingSpinner("AI analyzing your chat style", Colors.AI)
-    spinner.start()
-
-    try:
-        analysis_text = generate_response_stream(
-            client,
-            model="gemini-2.5-flash",
-            system_instruction_text="",
-            user_prompt_text=analysis_prompt
-        )
-        spinner.stop()
-    except Exception as e:
-        spinner.stop()
-        print_error(f"Failed to get analysis from Gemini: {e}")
-        analysis_text = "ERROR: analysis failed."
-
-    # Save analysis to user record and append to chat history
-    users = load_users()
-    if username in users:
-        users[username]["analysis"] = analysis_text
-        users[username]["analysis_generated_at"] = datetime.now(timezone.utc).isoformat()
-        save_users(users)
-
-    history = load_chat_history(username)
-    history.append({"sender": "AI", "text": analysis_text, "meta": {"analysis_result": True}})
-    save_chat_history(username, history)
+    # Create user record (no password fields); the analysis comes from a background job
+    create_user(
+        username,
+        created_at=datetime.now(timezone.utc).isoformat(),
+        starting_command=starting_command,
+        analysis=None,
+    )
+    write_corpus(username, [])  # the corpus exists before the chat starts, so it is never migrated over
+    flush_user_store()
+    job = JOBS.submit("signup import", import_chats_job(username, csv_path, announce=True))
 
-    pretty_print_analysis(analysis_text)
+    print_success("Signup complete!")
+    print_info(f"Your chats are imported and analyzed in the background (job #{job.id}, see /jobs); "
+               "until then replies follow your starting command.\n")
 
     return username
 
@@ -659,23 +2943,20 @@ def delete_account():
     """
     print_section_header("DELETE ACCOUNT")
 
-    users = load_users()
     username = input(f"{Colors.WARNING}Enter username to delete: {Colors.RESET}").strip()
 
     if not username:
         print_error("Username cannot be empty.")
         return False
 
-    if username not in users:
+    if not user_exists(username):
         print_error("User not found.")
         return False
 
-    rec = users[username]
-
     print_warning(f"\n⚠️  WARNING: This will permanently delete:")
     print(f"  - User account: {username}")
-    print(f"  - All stored memories ({len(rec.get('learning', []))} memories)")
-    print(f"  - Chat history")
+    print(f"  - All stored memories ({count_memories(username)} memories)")
+    print(f"  - Chat history and imported chats")
     print(f"  - Analysis data")
 
     confirm = input(f"\n{Colors.ERROR}Type 'DELETE' (in capitals) to confirm: {Colors.RESET}").strip()
@@ -687,21 +2968,17 @@ def delete_account():
     spinner = LoadingSpinner("Deleting account", Colors.ERROR)
     spinner.start()
 
-    # Delete chat history file
-    chat_path = get_user_chat_path(username)
-    if os.path.exists(chat_path):
-        try:
-            os.remove(chat_path)
-        except Exception as e:
-            spinner.stop()
-            print_error(f"Failed to delete chat history: {e}")
-            return False
-
-    # Remove user record
-    del users[username]
-    save_users(users)
+    # Delete chat history files
+    try:
+        delete_chat_history(username)
+        delete_corpus(username)
+    except Exception as e:
+        spinner.stop()
+        print_error(f"Failed to delete chat history: {e}")
+        return False
 
-    time.sleep(1)
+    # Remove user record (memories are removed with it)
+    delete_user(username)
     spinner.stop()
 
     print_success(f"Account '{username}' has been permanently deleted.")
@@ -739,8 +3016,11 @@ def print_commands():
             "category": "Session and Data Management",
             "items": [
                 {"command": f"{Colors.SUCCESS}exit{Colors.RESET} or {Colors.SUCCESS}quit{Colors.RESET}", "purpose": "Ends the current chat session."},
-                {"command": f"{Colors.SUCCESS}/upload_new_chat_data{Colors.RESET}", "purpose": "Uploads a new Instagram CSV file to update the AI's style profile."},
+                {"command": f"{Colors.SUCCESS}/upload_new_chat_data{Colors.RESET}", "purpose": "Uploads a new Instagram CSV file to update the AI's style profile. Runs in the background; the chat keeps the old profile until it finishes."},
+                {"command": f"{Colors.SUCCESS}/jobs [cancel <id>]{Colors.RESET}", "purpose": "Shows background imports/analyses with progress, elapsed time and errors, or cancels one."},
                 {"command": f"{Colors.SUCCESS}/owner <command>{Colors.RESET}", "purpose": "Explicitly instructs the AI that the command (e.g., /save_to_memory) is being issued by the owner, ensuring the AI maintains the owner's learned style and identity."},
+                {"command": f"{Colors.SUCCESS}/db_stats{Colors.RESET}", "purpose": "Shows user database cache hits/misses and bytes written."},
+                {"command": f"{Colors.SUCCESS}/cache [clear | clear expired | chat on|off]{Colors.RESET}", "purpose": "Shows response cache hits/misses, clears it, or lets chat replies use it."},
             ]
         },
         {
@@ -764,9 +3044,18 @@ def print_commands():
         {
             "category": "Memory Deletion",
             "items": [
-                {"command": f"{Colors.ERROR}/delete_memory{Colors.RESET}", "purpose": "Lists all stored memories with their SNo (Serial Number) and text."},
+                {"command": f"{Colors.ERROR}/delete_memory{Colors.RESET}", "purpose": f"Lists stored memories with their SNo (Serial Number) and text, {MEMORY_PAGE_SIZE} per page."},
+                {"command": f"{Colors.ERROR}/delete_memory --page <N>{Colors.RESET}", "purpose": "Shows page N of the memory listing."},
                 {"command": f"{Colors.ERROR}/delete_memory <SNo>{Colors.RESET}", "purpose": "Deletes the memory with the specified Serial Number (e.g., /delete_memory 5)."},
                 {"command": f"{Colors.ERROR}/delete_memory <keyword>{Colors.RESET}", "purpose": "Deletes any memory whose text contains the specified keyword (e.g., /delete_memory gym)."},
+                {"command": f"{Colors.SUCCESS}/search_memory <keyword> [/limit N]{Colors.RESET}", "purpose": "Lists memories containing the keyword (at most N results)."},
+            ]
+        },
+        {
+            "category": "Memory Selection",
+            "items": [
+                {"command": f"{Colors.SUCCESS}/pin_memory <SNo>{Colors.RESET}", "purpose": "Always include this memory in the prompt (/unpin_memory <SNo> to undo)."},
+                {"command": f"{Colors.SUCCESS}/memory_all on|off{Colors.RESET}", "purpose": f"Send every memory each turn instead of the {MEMORY_TOP_K} most relevant ones."},
             ]
         },
     ]
@@ -810,52 +3099,103 @@ def chat_loop(username):
     print_section_header(f"CHAT SESSION - {username}")
     
     client = get_genai_client()
-    users = load_users()
-    rec = users.get(username, {})
-
-    system_instruction = rec.get("analysis") or rec.get("starting_command") or "Mimic the user's style as best as possible."
-    history = load_chat_history(username)
+    rec = get_user(username) or {}
+
+    moved = migrate_chat_corpus(username)
+    recover_corpus_delta(username)
+    if moved:
+        print_info(f"Moved {moved:,} imported messages from the chat log to the corpus store.")
+    history = load_recent_chat_history(username, CHAT_TAIL_MSGS)
+    start_chat_compaction(username)
+    EXPIRY_REAPER.watch(username)
+    start_fewshot_index_build(username)
+    analysis = rec.get("analysis") or ""
+    has_corpus = os.path.getsize(get_user_corpus_path(username)) > 0
+    if (not analysis or analysis.startswith("ERROR:")) and has_corpus and not JOBS.active():
+        # e.g. the app was closed while the signup analysis was still running
+        job = JOBS.submit("analysis", import_chats_job(username))
+        print_info(f"Your imported chats have no analysis yet; analyzing them in the background (job #{job.id}).\n")
+    if not rec.get("style_profile"):
+        threading.Thread(target=refresh_style_profile, args=(username,), daemon=True).start()
+    include_all_memories = MEMORY_INCLUDE_ALL
+    chat_cache_enabled = RESPONSE_CACHE_CHAT
 
     custom_instructions = owner_instructions
 
     print_commands()
 
-    # Helper functions for processing AI directive lines
-    def _process_save_command(cmd_text):
-        payload = cmd_text.strip()
-        if payload.lower().startswith("/save_to_memory"):
-            payload = payload[len("/save_to_memory"):].strip()
-        else:
-            return False, None, None
-
-        if "/for" in payload:
-            fact_text, _, time_str = payload.partition("/for")
-            fact_text = fact_text.strip()
-            time_str = time_str.strip()
-            return True, fact_text, time_str
-        else:
-            return True, payload.strip(), None
-
-    def _process_delete_command(cmd_text):
-        payload = cmd_text.strip()
-        if payload.lower().startswith("/delete_from_memory"):
-            payload = payload[len("/delete_from_memory"):].strip()
-            return payload
-        return None
-
     while True:
-        # Clean expired memories before each turn
+        # Clean expired memories before each turn; persist what the previous command changed
         clean_expired_memories(username)
+        flush_turn_changes()
+
+        print_job_notices()
 
+        warm_up_genai_client()  # reconnect while the user types if the pooled connection went idle
         user_input = multiline_input()
         
         if not user_input:
             continue
         
+        lowered_cmd = user_input.strip().lower()
         if user_input.lower() in ("exit", "quit"):
+            if not confirm_exit_with_jobs():
+                continue
+            flush_turn_changes()
             print_success("Goodbye! Chat session ended.")
             break
 
+        if user_input.strip() == "/db_stats":
+            print_store_stats()
+            continue
+
+        if lowered_cmd.startswith("/jobs"):
+            arg = lowered_cmd[len("/jobs"):].strip()
+            if arg.startswith("cancel"):
+                job_id = arg[len("cancel"):].strip()
+                if not job_id.isdigit():
+                    print_warning("Usage: /jobs cancel <id>\n")
+                elif JOBS.cancel(int(job_id)):
+                    print_info(f"Cancelling job #{job_id}...\n")
+                else:
+                    print_warning(f"No queued or running job #{job_id}.\n")
+            else:
+                print_jobs()
+            continue
+
+        if lowered_cmd.startswith("/cache"):
+            arg = lowered_cmd[len("/cache"):].strip()
+            if arg == "clear":
+                print_success(f"Removed {RESPONSE_CACHE.clear()} cached responses.\n")
+            elif arg == "clear expired":
+                print_success(f"Removed {RESPONSE_CACHE.clear(expired_only=True)} expired responses.\n")
+            elif arg in ("chat on", "chat off"):
+                chat_cache_enabled = arg == "chat on"
+                print_info(f"Response cache for chat turns: {'on' if chat_cache_enabled else 'off'}\n")
+            elif arg:
+                print_warning("Usage: /cache [clear | clear expired | chat on|off]\n")
+            else:
+                print_cache_stats(chat_cache_enabled)
+            continue
+
+        if lowered_cmd.startswith("/memory_all"):
+            arg = lowered_cmd[len("/memory_all"):].strip()
+            if arg in ("on", "off"):
+                include_all_memories = arg == "on"
+            print_info(f"Send all memories every turn: {'on' if include_all_memories else 'off'}\n")
+            continue
+
+        if lowered_cmd.startswith(("/pin_memory", "/unpin_memory")):
+            cmd, _, arg = lowered_cmd.partition(" ")
+            arg = arg.strip()
+            if not arg.isdigit():
+                print_warning(f"Usage: {cmd} <SNo>\n")
+            elif USER_STORE.set_pinned(username, int(arg), cmd == "/pin_memory"):
+                print_success(f"{'Pinned' if cmd == '/pin_memory' else 'Unpinned'} memory SNo {arg}\n")
+            else:
+                print_warning(f"No memory with SNo {arg}.\n")
+            continue
+
         # Handle CSV upload
         if user_input.strip() == "/upload_new_chat_data":
             print_info("Select a new CSV file to upload...")
@@ -865,59 +3205,9 @@ def chat_loop(username):
                 print_error("No file selected or file not found. Aborting upload.\n")
                 continue
 
-            new_chats = process_csv_upload(csv_path)
-            if new_chats:
-                print_success(f"{len(new_chats)} messages loaded from new CSV.\n")
-                history.extend(new_chats)
-                save_chat_history(username, history)
-
-                print_info("AI is analyzing the new chat data...")
-                preview_msgs = new_chats[-CSV_PREVIEW_MSGS:] if new_chats else []
-                context_preview = "\n".join(f"{m['sender']}: {m['text']}" for m in preview_msgs if m.get("text"))
-                if not context_preview:
-                    context_preview = "(no previewable messages found in CSV)"
-
-                analysis_prompt = f"""
-You are an assistant whose job is to analyze the style, tone, language, and reply patterns of the target user,
-based on the new chat preview that follows. Do not wait for any user instructions — generate analysis automatically.
-
-Here is the new chat preview (most recent messages, up to {CSV_PREVIEW_MSGS} lines):
-{context_preview}
-
-Be concise but thorough. Include:
-- Overall tone & attitude
-- Typical vocabulary (slang, emojis, swearing, punctuation, formality)
-- Reply rhythm/timing patterns
-- Use of attachments/media
-- Typical reply length and structure
-- Example phrases or reply patterns
-- Instructions for assistant on how to mimic this user
-"""
-
-                spinner = LoadingSpinner("Analyzing new chat data", Colors.AI)
-                spinner.start()
-
-                try:
-                    new_analysis = generate_response_stream(
-                        client,model="gemini-2.5-flash",
-                        system_instruction_text="",
-                        user_prompt_text=analysis_prompt
-                    )
-                    spinner.stop()
-                    pretty_print_analysis(new_analysis)
-
-                    users = load_users()
-                    if username in users:
-                        users[username]["analysis"] = new_analysis
-                        users[username]["analysis_generated_at"] = datetime.now(timezone.utc).isoformat()
-                        save_users(users)
-
-                except Exception as e:
-                    spinner.stop()
-                    print_error(f"Failed to generate analysis for new chats: {e}")
-            else:
-                print_warning("No messages were loaded from the CSV.\n")
-
+            job = JOBS.submit("upload", import_chats_job(username, csv_path))
+            print_info(f"Importing {os.path.basename(csv_path)} in the background (job #{job.id}); "
+                       "keep chatting, the new analysis is used once it is ready. See /jobs.\n")
             continue
 
         # Handle memory save from user input (manual save commands)
@@ -960,27 +3250,46 @@ Be concise but thorough. Include:
             continue
 
         # Handle memory delete from user input
+        if lowered.startswith("/search_memory"):
+            query = user_input[len("/search_memory"):].strip()
+            limit = MEMORY_SEARCH_LIMIT
+            if "/limit" in query:
+                query, _, limit_str = query.partition("/limit")
+                query = query.strip()
+                limit = int(limit_str.strip()) if limit_str.strip().isdigit() else MEMORY_SEARCH_LIMIT
+            if not query:
+                print_warning("Usage: /search_memory <keyword> [/limit N]\n")
+                continue
+            results = search_learning(username, query, limit)
+            if not results:
+                print_warning("No matching memory found.\n")
+                continue
+            print_info(f"Memories matching '{query}' (showing up to {limit}):")
+            for lf in results:
+                print(format_memory_line(lf))
+            print()
+            continue
+
         if lowered.startswith("/delete_memory"):
             parts = user_input.split(maxsplit=1)
-            users = load_users()
-            learning_facts = users.get(username, {}).get("learning", [])
+            total = count_memories(username)
 
-            if not learning_facts:
+            if not total:
                 print_warning("No memories stored yet.\n")
                 continue
 
-            if len(parts) == 1:
-                print_info("Stored memories:")
-                for lf in learning_facts:
-                    if isinstance(lf, dict):
-                        sno = lf.get("sno")
-                        text = lf.get("text", "")
-                        expiry = lf.get("expiry")
-                        expiry_str = f" (expires {expiry})" if expiry else " (permanent)"
-                        print(f"  SNo {sno}. {text}{expiry_str}")
-                    else:
-                        # legacy fallback
-                        print(f"  {lf}")
+            page_arg = parts[1].strip().lower() if len(parts) > 1 else ""
+            if len(parts) == 1 or re.fullmatch(r"--page\s+\d+", page_arg):
+                pages = (total + MEMORY_PAGE_SIZE - 1) // MEMORY_PAGE_SIZE
+                page = int(page_arg.split()[1]) if page_arg else 1
+                page = min(max(page, 1), pages)
+                print_info(f"Stored memories (page {page}/{pages}, {total} total):")
+                learning_facts = USER_STORE.get_memories(username).values()
+                start = (page - 1) * MEMORY_PAGE_SIZE
+                for lf in itertools.islice(learning_facts, start, start + MEMORY_PAGE_SIZE):
+                    print(format_memory_line(lf))
+                if page < pages:
+                    print(f"\nNext page: `/delete_memory --page {page + 1}`")
                 print("\nUse `/delete_memory <SNo>` or `/delete_memory <keyword>` to remove.\n")
             else:
                 target = parts[1].strip()
@@ -998,25 +3307,21 @@ Be concise but thorough. Include:
         current_dt = datetime.now().strftime("%A, %B %d, %Y at %I:%M %p")
         time_context = f"Today is {current_dt}. Consider the current day and time while answering.\n\n"
 
-        # Reload users to get fresh memory data
-        users = load_users()
-        learning_facts = users.get(username, {}).get("learning", [])
-        
+        # Pick pinned + most relevant memories for this message (all of them with /memory_all on)
+        current_snos = [str(sno) for sno in USER_STORE.get_memories(username)]
+        learning_facts, all_mem_tokens, used_mem_tokens = select_memories_for_prompt(
+            username, user_input, include_all=include_all_memories)
+
         # Build memory context with PRIORITY EMPHASIS and SNo tracking
-        learning_text_parts = []
-        current_snos = []
-        for lf in learning_facts:
-            if isinstance(lf, dict):
-                sno = lf.get("sno")
-                current_snos.append(str(sno))
-                text = lf.get("text", "")
-                expiry = lf.get("expiry")
-                expiry_str = f" (expires {expiry})" if expiry else " (permanent)"
-                learning_text_parts.append(f"SNo {sno}: {text}{expiry_str}")
-            else:
-                learning_text_parts.append(f"- {lf}")
+        learning_text_parts = [format_prompt_memory(lf) for lf in learning_facts]
+        omitted = len(current_snos) - len(learning_facts)
+        if omitted:
+            learning_text_parts.append(f"({omitted} other stored memories were judged not relevant to this message "
+                                       f"and are not shown; their SNos are still valid)")
 
         learning_text = "\n".join(learning_text_parts) if learning_text_parts else "(no additional learning yet)"
+        print(f"{Colors.DIM}Memory context: {len(learning_facts)}/{len(current_snos)} memories, "
+              f"~{used_mem_tokens} tokens (saved ~{all_mem_tokens - used_mem_tokens}){Colors.RESET}")
 
         # Build conversation context with PRIORITY given to memories
         context_parts = []
@@ -1045,12 +3350,35 @@ Be concise but thorough. Include:
         context_parts.append("\n⚠️  THIS IS THE AUTHORITATIVE SOURCE OF TRUTH. Use this information with HIGHEST PRIORITY.\n")
         context_parts.append("=" * 80 + "\n\n")
 
+        # read every turn: a background job swaps in a new analysis and profile when it finishes
+        rec = get_user(username) or {}
+        system_instruction = rec.get("analysis") or rec.get("starting_command") or "Mimic the user's style as best as possible."
+        context_parts.append("=" * 80 + "\n")
+        context_parts.append("📊 MEASURED STYLE PROFILE (match these numbers: length, emojis, casing, punctuation)\n")
+        context_parts.append("=" * 80 + "\n")
+        context_parts.append(format_style_profile(rec.get("style_profile")) + "\n")
+        context_parts.append("=" * 80 + "\n\n")
+
         context_parts.append("=" * 80 + "\n")
         context_parts.append("👤 USER STYLE ANALYSIS (Reference for tone/style only)\n")
         context_parts.append("=" * 80 + "\n")
         context_parts.append(system_instruction + "\n")
         context_parts.append("=" * 80 + "\n\n")
 
+        fewshot_index = FEWSHOT_INDEXES.get(username)
+        if fewshot_index is not None and len(fewshot_index):
+            t0 = time.perf_counter()
+            examples = fewshot_index.examples(user_input)
+            if examples:
+                context_parts.append("=" * 80 + "\n")
+                context_parts.append("🗂️  HOW THE USER REALLY REPLIED TO SIMILAR MESSAGES (style reference only)\n")
+                context_parts.append("=" * 80 + "\n")
+                for sender, text, reply in examples:
+                    context_parts.append(f"{sender}: {text}\n{fewshot_index.owner}: {reply}\n\n")
+                context_parts.append("=" * 80 + "\n\n")
+            print(f"{Colors.DIM}Few-shot examples: {len(examples)} of {len(fewshot_index):,} pairs "
+                  f"({(time.perf_counter() - t0) * 1000:.1f} ms){Colors.RESET}")
+
         context_parts.append("=" * 80 + "\n")
         context_parts.append("📜 CUSTOM INSTRUCTIONS\n")
         context_parts.append("=" * 80 + "\n")
@@ -1070,7 +3398,7 @@ Be concise but thorough. Include:
         context_parts.append("Filtering out memory operation messages to reduce confusion...\n\n")
         
         # Filter chat history to exclude memory operation messages
-        recent_msgs = history[-40:]
+        recent_msgs = history[-CHAT_TAIL_MSGS:]
         included_count = 0
         for msg in recent_msgs:
             sender = msg.get("sender", "Unknown")
@@ -1107,103 +3435,92 @@ Be concise but thorough. Include:
 
         combined_system_prompt = "\n".join(context_parts)
 
-        # Generate AI reply
+        # ---------- Collect AI directives (/save_to_memory, /delete_from_memory, /used_memory, numeric deletion) ----------
+        # Directive lines are parsed as soon as they are complete in the stream and applied
+        # together after the reply (one validated batch, one write).
+        directives = []
+
+        def handle_directive(line):
+            op = parse_memory_directive(line)
+            if op is not None:
+                directives.append(op)
+
+        # -------------------------------------------------------------------------------
+
+        # Generate AI reply, streaming the visible text as it arrives
         spinner = LoadingSpinner("AI is thinking", Colors.AI)
         spinner.start()
-        reply = generate_response_stream(
+        started = time.perf_counter()
+        first_token_at = None
+
+        def show(text):
+            nonlocal first_token_at
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+                spinner.stop()
+                sys.stdout.write(f"\n{Colors.AI}{Colors.BOLD}AI:{Colors.RESET} ")
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+        reply_filter = DirectiveFilter(show, handle_directive)
+        call_info = {}
+        generate_response_stream(
             client,
             model="gemini-2.5-flash",
             system_instruction_text=combined_system_prompt,
-            user_prompt_text=user_input
+            user_prompt_text=user_input,
+            on_chunk=reply_filter.feed,
+            hedge_after_s=GENAI_HEDGE_AFTER_S,
+            info=call_info,
+            use_cache=chat_cache_enabled,
+            cacheable=lambda text: not has_directive_lines(text),  # a replayed directive would run again
         )
+        reply_filter.close()
         spinner.stop()
-        # ---------- Process AI directives (/save_to_memory, /delete_from_memory, /used_memory, numeric deletion) ----------
-        new_lines = []
-        memory_was_used = False
-        
-        for line in reply.splitlines():
-            low = line.lower().strip()
-
-            # Check for memory usage indicator
-            if low == "/used_memory":
-                memory_was_used = True
-                continue
-
-            # 1) Embedded explicit save command
-            if "/save_to_memory" in low:
-                idx = low.find("/save_to_memory")
-                cmd_text = line[idx:]
-                saved, fact_text, time_str = _process_save_command(cmd_text)
-                if saved and fact_text:
-                    if time_str:
-                        delta = parse_time_string(time_str)
-                        if delta:
-                            expiry = (datetime.now() + delta).isoformat()
-                            sno = add_learning(username, fact_text, expiry=expiry)
-                            if sno:
-                                print_success(f"AI auto-saved timed memory: SNo {sno}: {fact_text} (expires {time_str})")
-                            else:
-                                print_warning(f"AI attempted to save duplicate timed memory: {fact_text}")
-                        else:
-                            print_warning(f"AI tried saving with invalid time format: '{time_str}'")
-                    else:
-                        sno = add_learning(username, fact_text, expiry=None)
-                        if sno:
-                            print_success(f"AI auto-saved permanent memory: SNo {sno}: {fact_text}")
-                        else:
-                            print_warning(f"AI attempted to save duplicate memory: {fact_text}")
-                continue
-
-            # 2) Embedded explicit delete command
-            if "/delete_from_memory" in low:
-                idx = low.find("/delete_from_memory")
-                cmd_text = line[idx:]
-                target = _process_delete_command(cmd_text)
-                if target:
-                    deleted = forget_learning(username, target)
-                    if deleted:
-                        print_success(f"AI auto-deleted from memory: {', '.join(deleted)}")
-                    else:
-                        print_warning("AI attempted to delete from memory but found no match.")
-                continue
-
-            # 3) Numeric-only line: treat as "delete memory #n"
-            if low.isdigit():
-                sno_num = int(low)
-                deleted = forget_learning(username, str(sno_num))
-                if deleted:
-                    print_success(f"AI requested deletion: removed memory SNo {sno_num} -> {', '.join(deleted)}")
-                else:
-                    print_warning(f"AI requested deletion of memory SNo {sno_num}, but that SNo does not exist.")
-                continue
-
-            # otherwise keep the line for final display
-            new_lines.append(line)
+        total_s = time.perf_counter() - started
+        reply = reply_filter.text.strip()
+        if first_token_at is None:
+            print(f"\n{Colors.AI}{Colors.BOLD}AI:{Colors.RESET} ")
+        else:
+            print()
 
-        reply = "\n".join(new_lines).strip()
-        # -------------------------------------------------------------------------------
+        directive_report = apply_memory_directives(username, directives) if directives else []
 
         # After processing directives, run a final expired-clean check
         clean_expired_memories(username)
 
-        # Print AI reply with memory usage indicator
-        if memory_was_used:
-            print(f"\n{Colors.WARNING}📌 Memory Used{Colors.RESET}")
-
-        # Print AI reply (without directive lines)
-        print(f"\n{Colors.AI}{Colors.BOLD}AI:{Colors.RESET} {reply}\n")
+        # Memory usage indicator and directive results (the reply itself was streamed above)
+        if any(r["status"] == "used" for r in directive_report):
+            print(f"{Colors.WARNING}📌 Memory Used{Colors.RESET}")
+        for r in directive_report:
+            if r["status"] in ("saved", "deleted"):
+                print_success(f"AI auto-{r['status']} memory: {r['detail']}")
+            elif r["status"] != "used":
+                print_warning(f"AI memory directive {r['status']} ({r['detail']}): {r['directive']}")
+        ttft = f"{first_token_at - started:.2f}s" if first_token_at is not None else "n/a"
+        retry_note = ""
+        if call_info.get("cached"):
+            retry_note = " (from cache)"
+        elif call_info.get("attempts", 1) > 1:
+            retry_note = f" ({call_info['attempts']} requests{', hedged' if call_info.get('hedged') else ''})"
+        print(f"{Colors.DIM}First token: {ttft}, full reply: {total_s:.2f}s{retry_note}{Colors.RESET}")
         print(f"{Colors.DIM}{'─'*60}{Colors.RESET}\n")
 
         # Save chat history
-        history.append({"sender": "You", "text": user_input, "timestamp": datetime.now(timezone.utc).isoformat()})
-        history.append({"sender": "AI", "text": reply, "timestamp": datetime.now(timezone.utc).isoformat()})
-        save_chat_history(username, history)
+        turn = [
+            {"sender": "You", "text": user_input, "timestamp": datetime.now(timezone.utc).isoformat()},
+            {"sender": "AI", "text": reply, "timestamp": datetime.now(timezone.utc).isoformat()},
+        ]
+        append_chat_history(username, turn)
+        history = (history + turn)[-CHAT_TAIL_MSGS:]
+        flush_turn_changes()
 
 
 
 # ============ Main ============
 def main():
     print_banner()
+    warm_up_genai_client(force=True)  # connect while the user picks an option and logs in
     
     print(f"{Colors.PRIMARY}Welcome to your Personal AI Chat Assistant!{Colors.RESET}\n")
     print(f"{Colors.INFO}Please choose an option:{Colors.RESET}\n")
@@ -1222,7 +3539,6 @@ def main():
     elif choice in ["3", "delete", "delete account"]:
         if delete_account():
             print_info("\nReturning to main menu...\n")
-            time.sleep(2)
             main()  # Return to main menu after deletion
         return
     else:
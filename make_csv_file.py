@@ -1,17 +1,32 @@
-
-
-
-import json, os, sys, csv
+import json, os, sys, csv, re, io, heapq, tempfile, time, argparse, hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timezone
 try:
     from zoneinfo import ZoneInfo
 except Exception:
     from backports.zoneinfo import ZoneInfo
+try:
+    import resource  # peak RSS reporting (not available on Windows)
+except ImportError:
+    resource = None
+try:
+    import pyarrow as pa  # optional: typed columnar corpus (<base>_corpus/*.parquet)
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+try:
+    import ijson  # optional: faster incremental parser, stdlib fallback below
+except ImportError:
+    ijson = None
 
 # ---------- EDIT THIS (already set to the path you gave) ----------
 ROOT_FOLDER = r"C:\Users\HP\Documents\instagram-dhairya._.779-2025-09-30-Q1hi4wYq\your_instagram_activity\messages\inbox\dhairya_17848610517479048"
 # -----------------------------------------------------------------
 
+STREAM_CHUNK_SIZE = 1 << 16   # bytes read per step by the incremental parser
+MERGE_RUN_SIZE = 50000        # cleaned messages kept in memory before spilling a sorted run
+CORPUS_BATCH_ROWS = 65536     # rows per parquet row group
+
 def find_message_jsons(folder):
     """Return list of message json files (message_*.json or any .json containing 'messages' key)."""
     candidates = []
@@ -34,6 +49,13 @@ def find_message_jsons(folder):
     message_named = [p for p in candidates if os.path.basename(p).lower().startswith("message")]
     return message_named or candidates
 
+def find_message_parts(folder):
+    """Return every message json of a thread, ordered message_1, message_2, ... ."""
+    def part_number(path):
+        m = re.search(r"(\d+)", os.path.basename(path))
+        return int(m.group(1)) if m else 0
+    return sorted(find_message_jsons(folder), key=part_number)
+
 def safe_load_json(path):
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
@@ -92,7 +114,63 @@ def looks_like_system(text):
     patterns = ["unsent", "removed a message", "you unsent", "removed", "missed call", "video call", "was removed"]
     return any(p in lower for p in patterns)
 
-def resolve_media_attachments(msg, root_folder):
+class MediaIndex:
+    """
+    Basename -> path lookup for one thread's media, built with a single os.scandir pass
+    over photos/, videos/ and the thread root (same priority as the old exists() probes).
+    Unresolved URIs are collected so they can be reported once at the end.
+    """
+    SEARCH_DIRS = ("photos", "videos", "")
+
+    def __init__(self, root_folder):
+        self.root_folder = root_folder
+        self.paths = {}          # basename -> (path, number of exists() probes it used to cost)
+        self.unresolved = {}     # uri -> None (ordered set)
+        self.lookups = 0
+        self.stats_saved = 0
+        for probes, sub in enumerate(self.SEARCH_DIRS, 1):
+            folder = os.path.join(root_folder, sub) if sub else root_folder
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        if entry.is_file() and entry.name not in self.paths:
+                            self.paths[entry.name] = (os.path.join(folder, entry.name), probes)
+            except OSError:
+                continue
+
+    def resolve(self, uri):
+        self.lookups += 1
+        hit = self.paths.get(os.path.basename(uri))
+        if hit:
+            self.stats_saved += hit[1]
+            return hit[0]
+        self.stats_saved += len(self.SEARCH_DIRS)
+        self.unresolved[uri] = None
+        return uri
+
+    def report(self):
+        print(f"Media references: {self.lookups} - unresolved: {len(self.unresolved)} "
+              f"- stat calls saved: {self.stats_saved}")
+        for uri in list(self.unresolved)[:10]:
+            print("  unresolved:", uri)
+        if len(self.unresolved) > 10:
+            print(f"  ... and {len(self.unresolved) - 10} more")
+
+_MEDIA_INDEXES = {}
+
+def get_media_index(root_folder):
+    """Return the (cached) media index of a thread folder."""
+    idx = _MEDIA_INDEXES.get(root_folder)
+    if idx is None:
+        idx = _MEDIA_INDEXES[root_folder] = MediaIndex(root_folder)
+    return idx
+
+def release_media_index(root_folder):
+    return _MEDIA_INDEXES.pop(root_folder, None)
+
+def resolve_media_attachments(msg, root_folder, media_index=None):
+    if media_index is None:
+        media_index = get_media_index(root_folder)
     out = []
     # typical keys
     for key in ("photos","videos","files","attachments"):
@@ -107,23 +185,8 @@ def resolve_media_attachments(msg, root_folder):
                                 uri = it[kk]
                                 break
                     if uri:
-                        basename = os.path.basename(uri)
-                        # try common locations: .../photos/..., .../videos/..., root_folder
-                        tried = []
-                        candidate = os.path.join(root_folder, "photos", basename)
-                        tried.append(candidate)
-                        if os.path.exists(candidate):
-                            out.append(candidate); continue
-                        candidate = os.path.join(root_folder, "videos", basename)
-                        tried.append(candidate)
-                        if os.path.exists(candidate):
-                            out.append(candidate); continue
-                        candidate = os.path.join(root_folder, basename)
-                        tried.append(candidate)
-                        if os.path.exists(candidate):
-                            out.append(candidate); continue
-                        # fallback: include original uri so user can locate manually
-                        out.append(uri)
+                        # photos/, videos/, root_folder - falls back to the original uri so user can locate manually
+                        out.append(media_index.resolve(uri))
     # share objects
     if "share" in msg and isinstance(msg["share"], dict):
         s = msg["share"]
@@ -144,115 +207,630 @@ def get_reactions(msg):
         return ";".join(parts)
     return ""
 
+def find_messages_in(data):
+    """Locate the messages array inside an already loaded json document."""
+    if isinstance(data, dict) and "messages" in data:
+        return data["messages"]
+    if isinstance(data, list):
+        return data
+    # walk for nested 'messages'
+    def walk(o):
+        if isinstance(o, dict):
+            for k,v in o.items():
+                if k=="messages" and isinstance(v, list):
+                    return v
+                r = walk(v)
+                if r:
+                    return r
+        elif isinstance(o, list):
+            for i in o:
+                r = walk(i)
+                if r:
+                    return r
+        return None
+    return walk(data)
+
+def clean_message(m, root_folder, keep_raw=True):
+    """Turn one raw export message into a cleaned record, or None if it should be skipped."""
+    text = get_text_from_msg(m)
+    # skip empty system messages unless they include media/share
+    if looks_like_system(text) and not any(k in m for k in ("photos","videos","share")):
+        return None
+    ms = get_timestamp_ms(m)
+    rec = {
+        "timestamp_ms": ms,
+        "timestamp_iso": ms_to_ist_iso(ms),
+        "sender": normalize_sender(m),
+        "text": text,
+        "attachments": resolve_media_attachments(m, root_folder),
+        "reactions": get_reactions(m),
+    }
+    if keep_raw:
+        rec["raw"] = m
+    return rec
+
+def timestamp_key(rec):
+    return rec["timestamp_ms"] if rec["timestamp_ms"] is not None else 0
+
+def message_key(rec):
+    """Short hash of (timestamp, sender, content): tells apart messages sent in the same millisecond."""
+    content = json.dumps([rec["timestamp_ms"], rec["sender"], rec["text"], rec["attachments"]], ensure_ascii=False)
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=8).hexdigest()
+
 def extract_messages_from_json(path, root_folder):
     data = safe_load_json(path)
-    # find messages array
-    if isinstance(data, dict) and "messages" in data:
-        messages = data["messages"]
-    elif isinstance(data, list):
-        messages = data
-    else:
-        # walk for nested 'messages'
-        def walk(o):
-            if isinstance(o, dict):
-                for k,v in o.items():
-                    if k=="messages" and isinstance(v, list):
-                        return v
-                    r = walk(v)
-                    if r:
-                        return r
-            elif isinstance(o, list):
-                for i in o:
-                    r = walk(i)
-                    if r:
-                        return r
-            return None
-        messages = walk(data)
+    messages = find_messages_in(data)
     if messages is None:
         return []
     cleaned = []
     for m in messages:
-        text = get_text_from_msg(m)
-        # skip empty system messages unless they include media/share
-        if looks_like_system(text) and not any(k in m for k in ("photos","videos","share")):
-            continue
-        sender = normalize_sender(m)
-        ms = get_timestamp_ms(m)
-        iso = ms_to_ist_iso(ms)
-        attachments = resolve_media_attachments(m, root_folder)
-        reactions = get_reactions(m)
-        cleaned.append({
-            "timestamp_ms": ms,
-            "timestamp_iso": iso,
-            "sender": sender,
-            "text": text,
-            "attachments": attachments,
-            "reactions": reactions,
-            "raw": m
-        })
+        rec = clean_message(m, root_folder)
+        if rec is not None:
+            cleaned.append(rec)
     # sort by timestamp
-    cleaned = sorted(cleaned, key=lambda x: x["timestamp_ms"] if x["timestamp_ms"] is not None else 0)
+    cleaned = sorted(cleaned, key=timestamp_key)
     return cleaned
 
-def write_outputs(cleaned, out_dir, base_name="dhairya_chat"):
+# ---------- Streaming ingestion ----------
+_MESSAGES_KEY = re.compile(r'"messages"\s*:\s*\[')
+
+def _iter_array_items_stdlib(f):
+    """
+    Incrementally decode the items of the "messages" array (or of a top-level array)
+    from a text file object, holding at most one item plus one read chunk in memory.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    eof = False
+
+    def fill():
+        nonlocal buf, eof
+        chunk = f.read(STREAM_CHUNK_SIZE)
+        if chunk:
+            buf += chunk
+        else:
+            eof = True
+
+    # locate the start of the array
+    pos = None
+    while pos is None:
+        stripped = buf.lstrip()
+        if stripped.startswith("["):
+            pos = len(buf) - len(stripped) + 1
+            break
+        m = _MESSAGES_KEY.search(buf)
+        if m:
+            pos = m.end()
+            break
+        if eof:
+            return
+        # keep a small tail so a key split across two reads is still found
+        if len(buf) > STREAM_CHUNK_SIZE:
+            buf = buf[-64:]
+        fill()
+
+    buf = buf[pos:]
+    while True:
+        # skip separators
+        i = 0
+        while True:
+            while i < len(buf) and buf[i] in " \t\r\n,":
+                i += 1
+            if i < len(buf) or eof:
+                break
+            buf = ""
+            i = 0
+            fill()
+        buf = buf[i:]
+        if not buf or buf[0] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buf)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        yield item
+        buf = buf[end:]
+
+def _iter_array_items_ijson(f):
+    first = f.read(1)
+    while first and first.isspace():
+        first = f.read(1)
+    f.seek(0)
+    prefix = "item" if first == b"[" else "messages.item"
+    yield from ijson.items(f, prefix, use_float=True)
+
+def iter_raw_messages(path):
+    """Yield raw messages from one export file without building the whole document tree."""
+    found = False
+    if ijson is not None:
+        with open(path, "rb") as f:
+            for item in _iter_array_items_ijson(f):
+                found = True
+                yield item
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            for item in _iter_array_items_stdlib(f):
+                found = True
+                yield item
+    if not found:
+        # unusual layout (deeply nested 'messages'): fall back to a full load
+        messages = find_messages_in(safe_load_json(path)) or []
+        yield from messages
+
+def _write_run(records, tmp_dir, run_no):
+    path = os.path.join(tmp_dir, f"run_{run_no:05d}.jsonl")
+    records.sort(key=timestamp_key)
+    with open(path, "w", encoding="utf-8") as f:
+        for r in records:
+            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    return path
+
+def _iter_run(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+def iter_thread_messages(root_folder, paths=None, keep_raw=False):
+    """
+    Stream the cleaned messages of every message_N.json in a thread, oldest first.
+
+    Each part file is parsed incrementally; cleaned records are collected into runs of
+    MERGE_RUN_SIZE, each run is sorted and spilled to a temp file, and all runs are
+    combined with a k-way heap merge on timestamp_ms. Peak memory is bounded by one
+    run, whatever the size of the thread.
+    """
+    if paths is None:
+        paths = find_message_parts(root_folder)
+    with tempfile.TemporaryDirectory(prefix="ig_ingest_") as tmp_dir:
+        runs = []
+        buf = []
+        for path in paths:
+            for m in iter_raw_messages(path):
+                if not isinstance(m, dict):
+                    continue
+                rec = clean_message(m, root_folder, keep_raw=keep_raw)
+                if rec is None:
+                    continue
+                buf.append(rec)
+                if len(buf) >= MERGE_RUN_SIZE:
+                    runs.append(_write_run(buf, tmp_dir, len(runs)))
+                    buf = []
+        buf.sort(key=timestamp_key)
+        if not runs:
+            # small thread: everything fit in one in-memory run
+            yield from buf
+            return
+        streams = [_iter_run(p) for p in runs] + [iter(buf)]
+        yield from heapq.merge(*streams, key=timestamp_key)
+
+def output_paths(out_dir, base_name):
+    return (os.path.join(out_dir, base_name + "_clean.jsonl"),
+            os.path.join(out_dir, base_name + "_clean.csv"),
+            os.path.join(out_dir, base_name + "_fewshots.jsonl"))
+
+def corpus_path(out_dir, base_name):
+    return os.path.join(out_dir, base_name + "_corpus")
+
+class CorpusWriter:
+    """
+    Writes the columnar corpus read by main.py: a directory of parquet files with
+    int64 timestamp_ms, dictionary-encoded sender, text, list<string> attachments and
+    reactions. A fresh write replaces the directory; an append adds one more part file.
+    """
+    SCHEMA = pa.schema([
+        ("timestamp_ms", pa.int64()),
+        ("sender", pa.dictionary(pa.int32(), pa.string())),
+        ("text", pa.string()),
+        ("attachments", pa.list_(pa.string())),
+        ("reactions", pa.string()),
+    ]) if pa is not None else None
+
+    def __init__(self, folder, append=False):
+        os.makedirs(folder, exist_ok=True)
+        existing = sorted(n for n in os.listdir(folder) if n.endswith(".parquet"))
+        if not append:
+            for n in existing:
+                os.remove(os.path.join(folder, n))
+            existing = []
+        self.path = os.path.join(folder, f"part-{len(existing):05d}.parquet")
+        self.writer = None
+        self.cols = {name: [] for name in self.SCHEMA.names}
+
+    def write(self, rec):
+        cols = self.cols
+        cols["timestamp_ms"].append(rec["timestamp_ms"])
+        cols["sender"].append(rec["sender"])
+        cols["text"].append(rec["text"])
+        cols["attachments"].append(rec["attachments"])
+        cols["reactions"].append(rec["reactions"])
+        if len(cols["text"]) >= CORPUS_BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if not self.cols["text"]:
+            return
+        table = pa.table(self.cols, schema=self.SCHEMA)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, self.SCHEMA)
+        self.writer.write_table(table)
+        self.cols = {name: [] for name in self.SCHEMA.names}
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+def write_outputs(cleaned, out_dir, base_name="dhairya_chat", state=None):
+    """
+    Stream cleaned records (any iterable, e.g. iter_thread_messages) into the compact
+    json-lines, csv and few-shot jsonl files in a single pass, so the whole thread is
+    never held in memory. Few-shot candidates are spooled to a temp file until the
+    most frequent sender ("you") is known. When pyarrow is installed the records also go
+    to the columnar corpus (see CorpusWriter).
+    `state` (optional dict) carries what a later run needs to continue: sender counts,
+    the last written message, its timestamp and the message_key of every message with
+    that timestamp (boundary_keys). If it already holds a previous run's
+    state, the records are appended to the existing files instead of replacing them.
+    """
     os.makedirs(out_dir, exist_ok=True)
-    json_path = os.path.join(out_dir, base_name + "_clean.json")
-    csv_path = os.path.join(out_dir, base_name + "_clean.csv")
-    jsonl_path = os.path.join(out_dir, base_name + "_fewshots.jsonl")
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(cleaned, f, ensure_ascii=False, indent=2)
-    with open(csv_path, "w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        w.writerow(["timestamp_iso","sender","text","attachments","reactions"])
+    json_path, csv_path, jsonl_path = output_paths(out_dir, base_name)
+    append = bool(state) and "tail" in state
+    mode = "a" if append else "w"
+    senders_count = dict(state["senders_count"]) if append else {}
+    last_ts = state["last_timestamp_ms"] if append else 0
+    boundary = list(state.get("boundary_keys", [])) if append else []
+    a = state["tail"] if append else None
+    written = 0
+    pair_count = 0
+    corpus = CorpusWriter(corpus_path(out_dir, base_name), append) if pa is not None else None
+    with open(json_path, mode, encoding="utf-8") as fj, \
+         open(csv_path, mode, newline="", encoding="utf-8") as fc, \
+         tempfile.TemporaryFile("w+", encoding="utf-8") as spool:
+        w = csv.writer(fc)
+        if not append:
+            w.writerow(["timestamp_iso","sender","text","attachments","reactions"])
         for c in cleaned:
+            fj.write(json.dumps(c, ensure_ascii=False) + "\n")
             w.writerow([c["timestamp_iso"], c["sender"], c["text"], ";".join(c["attachments"]), c["reactions"]])
-    # build few-shot pairs (heuristic)
-    senders_count = {}
-    for c in cleaned:
-        senders_count[c["sender"]] = senders_count.get(c["sender"], 0) + 1
-    you = max(senders_count.items(), key=lambda kv: kv[1])[0] if senders_count else None
-    pairs = []
-    for i in range(len(cleaned)-1):
-        a = cleaned[i]
-        b = cleaned[i+1]
-        if a["sender"] != you and b["sender"] == you:
-            if a["timestamp_ms"] and b["timestamp_ms"]:
-                diff = (b["timestamp_ms"] - a["timestamp_ms"]) / 1000.0
-            else:
-                diff = None
-            if diff is None or diff <= 48*3600:
-                prompt = f"{a['sender']}: {a['text']}"
-                response = b["text"]
-                if prompt.strip() and response.strip():
-                    pairs.append({"prompt": prompt, "response": response})
-    with open(jsonl_path, "w", encoding="utf-8") as f:
-        for p in pairs:
-            f.write(json.dumps(p, ensure_ascii=False) + "\n")
-    return json_path, csv_path, jsonl_path, you, len(pairs)
+            if corpus is not None:
+                corpus.write(c)
+            senders_count[c["sender"]] = senders_count.get(c["sender"], 0) + 1
+            # few-shot pair candidate (heuristic): kept later if c's sender turns out to be "you"
+            if a is not None and a["sender"] != c["sender"]:
+                if a["timestamp_ms"] and c["timestamp_ms"]:
+                    diff = (c["timestamp_ms"] - a["timestamp_ms"]) / 1000.0
+                else:
+                    diff = None
+                if diff is None or diff <= 48*3600:
+                    prompt = f"{a['sender']}: {a['text']}"
+                    response = c["text"]
+                    if prompt.strip() and response.strip():
+                        spool.write(json.dumps([c["sender"], prompt, response], ensure_ascii=False) + "\n")
+            a = c
+            written += 1
+            ts = timestamp_key(c)
+            if ts > last_ts:
+                last_ts, boundary = ts, []
+            if ts == last_ts:
+                boundary.append(message_key(c))
+        if corpus is not None:
+            corpus.close()
+        you = max(senders_count.items(), key=lambda kv: kv[1])[0] if senders_count else None
+        spool.seek(0)
+        with open(jsonl_path, mode, encoding="utf-8") as f:
+            for line in spool:
+                responder, prompt, response = json.loads(line)
+                if responder == you:
+                    f.write(json.dumps({"prompt": prompt, "response": response}, ensure_ascii=False) + "\n")
+                    pair_count += 1
+    if state is not None:
+        if not append:
+            state.clear()
+            state.update(messages=0, pairs=0, tail=None)
+        state["senders_count"] = senders_count
+        state["you"] = you
+        state["messages"] += written
+        state["pairs"] += pair_count
+        state["last_timestamp_ms"] = last_ts
+        state["boundary_keys"] = boundary
+        if written:
+            state["tail"] = {"sender": a["sender"], "text": a["text"], "timestamp_ms": a["timestamp_ms"]}
+    return json_path, csv_path, jsonl_path, you, pair_count
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, or None where it can't be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+# ---------- Incremental ingestion ----------
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def load_manifest(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_manifest(path, manifest):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+def after_boundary(records, state):
+    """
+    The records a previous run (`state`) has not written: later than its last timestamp,
+    or at that timestamp and not among its boundary_keys (Instagram has same-millisecond
+    messages, so the timestamp alone would drop them).
+    """
+    last = state.get("last_timestamp_ms") or 0
+    if "boundary_keys" not in state:  # manifest of an older version
+        yield from (r for r in records if timestamp_key(r) > last)
+        return
+    seen = {}
+    for k in state["boundary_keys"]:
+        seen[k] = seen.get(k, 0) + 1
+    for r in records:
+        ts = timestamp_key(r)
+        if ts < last:
+            continue
+        if ts == last:
+            k = message_key(r)
+            if seen.get(k):
+                seen[k] -= 1
+                continue
+        yield r
+
+def ingest_thread(folder, out_dir=None, base_name="dhairya_chat", full=False, keep_raw=False):
+    """
+    Ingest a thread, reusing `<base_name>_manifest.json` from the previous run.
+
+    Part files whose size and mtime are unchanged are not even opened; changed ones are
+    hashed and only those whose content really differs are parsed. Messages newer than
+    the last ingested timestamp_ms (or at it, but not ingested yet, see after_boundary)
+    are appended to the existing outputs. A missing part
+    file, missing outputs or `full=True` trigger a rebuild from scratch.
+    Returns a summary dict (messages, new, bytes, seconds, msgs_per_sec, peak_rss_mb, ...).
+    """
+    start = time.perf_counter()
+    out_dir = out_dir or folder
+    manifest_path = os.path.join(out_dir, base_name + "_manifest.json")
+    json_path, csv_path, jsonl_path = output_paths(out_dir, base_name)
+    manifest = None if full else load_manifest(manifest_path)
+    if manifest and not all(os.path.exists(p) for p in (json_path, csv_path, jsonl_path)):
+        manifest = None
+    if manifest and pa is not None and not os.path.isdir(corpus_path(out_dir, base_name)):
+        manifest = None  # pyarrow was installed after the last run
+
+    parts = find_message_parts(folder)
+    old_files = manifest["files"] if manifest else {}
+    files, changed = {}, []
+    for p in parts:
+        st = os.stat(p)
+        name = os.path.basename(p)
+        old = old_files.get(name)
+        entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        if old and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+            entry["sha256"] = old["sha256"]
+        else:
+            entry["sha256"] = file_sha256(p)
+            if not old or old["sha256"] != entry["sha256"]:
+                changed.append(p)
+        files[name] = entry
+    if manifest and set(old_files) - set(files):
+        manifest = None  # a part file disappeared: appended rows can't be taken back
+
+    if manifest is None:
+        state = {}
+        write_outputs(iter_thread_messages(folder, parts, keep_raw=keep_raw), out_dir, base_name, state=state)
+        new = state["messages"]
+    else:
+        state = manifest["state"]
+        before = state.get("messages", 0)
+        if changed:
+            fresh = after_boundary(iter_thread_messages(folder, changed, keep_raw=keep_raw), state)
+            write_outputs(fresh, out_dir, base_name, state=state)
+        new = state.get("messages", 0) - before
+    if manifest is None or files != old_files or new:
+        save_manifest(manifest_path, {"files": files, "state": state,
+                                      "updated_at": datetime.now(timezone.utc).isoformat()})
+    seconds = time.perf_counter() - start
+    return {
+        "thread": os.path.basename(os.path.normpath(folder)), "folder": folder,
+        "messages": state.get("messages", 0), "new": new,
+        "bytes": sum(f["size"] for f in files.values()),
+        "seconds": round(seconds, 3),
+        "msgs_per_sec": round(new / seconds) if new and seconds else 0,
+        "peak_rss_mb": peak_rss_mb(),
+        "you": state.get("you"), "pairs": state.get("pairs", 0),
+        "outputs": (json_path, csv_path, jsonl_path) + ((corpus_path(out_dir, base_name),) if pa is not None else ()),
+        "csv": csv_path,
+        "rebuilt": manifest is None, "parsed_files": len(parts) if manifest is None else len(changed),
+    }
+
+# ---------- Whole-inbox ingestion ----------
+def find_thread_folders(inbox_root):
+    """Return every conversation folder under messages/inbox that holds message json files."""
+    threads = []
+    for entry in sorted(os.scandir(inbox_root), key=lambda e: e.name):
+        if not entry.is_dir():
+            continue
+        try:
+            names = os.listdir(entry.path)
+        except OSError:
+            continue
+        if any(n.lower().startswith("message") and n.lower().endswith(".json") for n in names):
+            threads.append(entry.path)
+    return threads
+
+def process_thread(folder, full=False, keep_raw=False):
+    """
+    Ingest one thread into its own folder. Runs inside a worker process, which handles
+    other threads too: worker_peak_rss_mb is that process's peak so far, not the thread's.
+    """
+    name = os.path.basename(os.path.normpath(folder))
+    summary = {"thread": name, "folder": folder, "messages": 0, "new": 0, "bytes": 0,
+               "seconds": 0.0, "msgs_per_sec": 0, "you": None, "pairs": 0, "csv": None, "error": "",
+               "media_refs": 0, "unresolved_media": 0, "stats_saved": 0}
+    try:
+        summary.update(ingest_thread(folder, folder, base_name=name, full=full, keep_raw=keep_raw))
+    except Exception as e:
+        summary["error"] = f"{type(e).__name__}: {e}"
+    summary.pop("peak_rss_mb", None)
+    summary.update(worker_pid=os.getpid(), worker_peak_rss_mb=peak_rss_mb())
+    media = release_media_index(folder)
+    if media is not None:
+        summary.update(media_refs=media.lookups, unresolved_media=len(media.unresolved),
+                       stats_saved=media.stats_saved)
+    return summary
+
+def _copy_thread_rows(w, thread, csv_path, offset):
+    """Write a per-thread CSV's rows from byte `offset` on (0: skip the header); returns the row count."""
+    rows = 0
+    with open(csv_path, "rb") as raw:
+        raw.seek(offset)
+        f = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+        r = csv.reader(f)
+        if not offset:
+            next(r, None)  # header
+        for row in r:
+            w.writerow([thread] + row)
+            rows += 1
+        f.detach()
+    return rows
+
+def write_combined_corpus(summaries, out_path):
+    """
+    Keep one corpus of every per-thread CSV, with a leading `thread` column, up to date.
+    `<out_path>.state.json` records how many bytes of each thread's CSV were copied. The
+    thread CSVs only grow on an incremental run, so just their new rows are appended and
+    nothing is written when no thread changed. A rebuilt or vanished thread (or a missing
+    or edited corpus) rewrites the whole file, grouped by thread.
+    Returns the number of rows written.
+    """
+    state_path = out_path + ".state.json"
+    state = load_manifest(state_path)
+    copied = state["threads"] if state else {}
+    names = {s["thread"] for s in summaries}
+    sizes = {s["thread"]: os.path.getsize(s["csv"]) for s in summaries if s["csv"]}
+    rewrite = (state is None or not os.path.exists(out_path)
+               or os.path.getsize(out_path) != state.get("corpus_bytes")
+               or any(t not in names for t in copied)
+               or any(s["rebuilt"] or sizes[s["thread"]] < copied[s["thread"]]
+                      for s in summaries if s["csv"] and s["thread"] in copied))
+    if rewrite:
+        copied = {}
+    pending = [s for s in summaries if s["csv"] and sizes[s["thread"]] != copied.get(s["thread"])]
+    if not rewrite and not pending:
+        return 0
+    rows = 0
+    with open(out_path, "w" if rewrite else "a", newline="", encoding="utf-8") as out:
+        w = csv.writer(out)
+        if rewrite:
+            w.writerow(["thread","timestamp_iso","sender","text","attachments","reactions"])
+        for s in pending:
+            rows += _copy_thread_rows(w, s["thread"], s["csv"], copied.get(s["thread"], 0))
+            copied[s["thread"]] = sizes[s["thread"]]
+    save_manifest(state_path, {"threads": copied, "corpus_bytes": os.path.getsize(out_path)})
+    return rows
+
+def write_inbox_summary(summaries, out_path):
+    cols = ["thread","messages","new","bytes","seconds","msgs_per_sec","worker_pid","worker_peak_rss_mb","you","pairs",
+            "media_refs","unresolved_media","stats_saved","error"]
+    with open(out_path, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(cols)
+        for s in summaries:
+            w.writerow([s[c] for c in cols])
+
+def ingest_inbox(inbox_root, workers=None, full=False, keep_raw=False):
+    """Ingest every thread of an export in a process pool and write the combined outputs."""
+    threads = find_thread_folders(inbox_root)
+    if not threads:
+        print("No conversation folders found in:", inbox_root)
+        return []
+    # biggest threads first so one large conversation does not finish last on its own
+    sizes = {t: sum(os.path.getsize(p) for p in find_message_jsons(t)) for t in threads}
+    threads.sort(key=lambda t: sizes[t], reverse=True)
+    workers = workers or os.cpu_count() or 1
+    print(f"Ingesting {len(threads)} threads with {workers} worker process(es)...")
+    start = time.perf_counter()
+    summaries = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(process_thread, t, full, keep_raw) for t in threads]
+        for done, fut in enumerate(as_completed(futures), 1):
+            s = fut.result()
+            summaries.append(s)
+            status = "ERROR " + s["error"] if s["error"] else f"{s['new']} new / {s['messages']} msgs in {s['seconds']}s"
+            print(f"  [{done}/{len(threads)}] {s['thread']}: {status}")
+    summaries.sort(key=lambda s: s["thread"])
+    combined_path = os.path.join(inbox_root, "inbox_corpus.csv")
+    summary_path = os.path.join(inbox_root, "inbox_summary.csv")
+    combined_rows = write_combined_corpus(summaries, combined_path)
+    write_inbox_summary(summaries, summary_path)
+    elapsed = time.perf_counter() - start
+    total = sum(s["messages"] for s in summaries)
+    print("WROTE:\n ", combined_path, f"({combined_rows} rows written)\n ", summary_path)
+    print(f"Total: {total} messages from {len(summaries)} threads in {elapsed:.1f}s "
+          f"({sum(s['seconds'] for s in summaries):.1f}s of worker time)")
+    print(f"Media: {sum(s['media_refs'] for s in summaries)} references, "
+          f"{sum(s['unresolved_media'] for s in summaries)} unresolved "
+          f"(see inbox_summary.csv), {sum(s['stats_saved'] for s in summaries)} stat calls saved")
+    return summaries
 
 def main():
-    root = ROOT_FOLDER
+    parser = argparse.ArgumentParser(description="Convert an Instagram chat export into CSV / few-shot files.")
+    parser.add_argument("folder", nargs="?", default=ROOT_FOLDER, help="thread folder (defaults to ROOT_FOLDER)")
+    parser.add_argument("--inbox", metavar="INBOX_ROOT", help="ingest every thread under messages/inbox")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes for --inbox (default: CPU count)")
+    parser.add_argument("--full", action="store_true", help="ignore the manifest and rebuild all outputs")
+    parser.add_argument("--keep-raw", action="store_true", help="also store each original export message in _clean.jsonl")
+    args = parser.parse_args()
+
+    if args.inbox:
+        if not os.path.isdir(args.inbox):
+            print("Inbox folder not found:", args.inbox)
+            sys.exit(1)
+        ingest_inbox(args.inbox, args.workers, args.full, args.keep_raw)
+        return
+
+    root = args.folder
     if not os.path.exists(root):
         print("ROOT_FOLDER not found:", root)
         sys.exit(1)
     print("Scanning folder:", root)
-    jsons = find_message_jsons(root)
-    if not jsons:
+    parts = find_message_parts(root)
+    if not parts:
         print("No JSON files found in folder.")
         sys.exit(1)
-    # prefer message_1.json if present
-    preferred = None
-    for p in jsons:
-        if os.path.basename(p).lower().startswith("message"):
-            preferred = p; break
-    if not preferred:
-        preferred = jsons[0]
-    print("Using JSON:", preferred)
-    cleaned = extract_messages_from_json(preferred, root)
-    out_json, out_csv, out_jsonl, you, pair_count = write_outputs(cleaned, root)
-    print("WROTE:\n ", out_json, "\n ", out_csv, "\n ", out_jsonl)
-    print("Detected your sender name (most messages):", you)
-    print("Total cleaned messages:", len(cleaned), " - fewshot pairs:", pair_count)
+    print(f"Found {len(parts)} JSON part(s):", ", ".join(os.path.basename(p) for p in parts))
+    summary = ingest_thread(root, root, full=args.full, keep_raw=args.keep_raw)
+    if summary["rebuilt"]:
+        print("Full ingest of", summary["parsed_files"], "file(s).")
+    elif summary["new"] or summary["parsed_files"]:
+        print(f"Incremental ingest: {summary['parsed_files']} changed file(s), {summary['new']} new message(s) appended.")
+    else:
+        print(f"Up to date (checked in {summary['seconds']}s).")
+    print("WROTE:\n ", "\n  ".join(summary["outputs"]))
+    print("Detected your sender name (most messages):", summary["you"])
+    print("Total cleaned messages:", summary["messages"], " - fewshot pairs:", summary["pairs"])
+    if summary["new"]:
+        rss = summary["peak_rss_mb"]
+        print(f"Throughput: {summary['msgs_per_sec']} msgs/s - peak RSS: {rss if rss is not None else 'n/a'} MB")
+    media = release_media_index(root)
+    if media is not None:
+        media.report()
 
 if __name__ == "__main__":
     main()
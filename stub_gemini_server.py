@@ -0,0 +1,161 @@
+"""
+stub_gemini_server.py
+
+Local stand-in for the Gemini REST endpoint, for benchmarks and tests without an API key.
+Answers generateContent and streamGenerateContent (?alt=sse) with a canned reply split
+into chunks. New connections can be slowed down to mimic a TLS handshake, so the effect
+of connection reuse is visible on localhost.
+
+Faults can be injected per request, in order (--faults 429,503,reset,slow,ok,...):
+  429 / 500 / 503 / 400   error response with that status
+  reset                   connection closed without a response
+  slow                    first chunk delayed by --slow-ms (for hedging)
+  midstream               connection closed after the first chunk
+  ok                      normal reply
+Requests beyond the list are answered normally.
+
+Usage:
+  python stub_gemini_server.py --port 8765 --handshake-ms 150 --ttft-ms 300
+  python stub_gemini_server.py --faults 429,503,ok
+  GEMINI_BASE_URL=http://127.0.0.1:8765 python main.py
+"""
+
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = "haan bro, bilkul. kal milte hai gym pe 6 baje"
+ERROR_STATUS = {400: "INVALID_ARGUMENT", 429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE"}
+
+
+class StubConfig:
+    def __init__(self, handshake_ms=150, ttft_ms=300, chunk_ms=20, chunks=6, reply=DEFAULT_REPLY,
+                 faults=None, slow_ms=5000):
+        self.handshake_ms = handshake_ms  # delay before a new connection is served
+        self.ttft_ms = ttft_ms            # delay before the first chunk
+        self.chunk_ms = chunk_ms          # delay between chunks
+        self.chunks = chunks
+        self.reply = reply
+        self.faults = list(faults or [])  # consumed one per request
+        self.slow_ms = slow_ms
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+
+
+def split_reply(text, n):
+    words = text.split(" ")
+    size = max(1, -(-len(words) // n))
+    return [" ".join(words[i:i + size]) + (" " if i + size < len(words) else "")
+            for i in range(0, len(words), size)]
+
+
+def chunk_json(text, last=False):
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+    if last:
+        candidate["finishReason"] = "STOP"
+    return {"candidates": [candidate], "modelVersion": "stub"}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive
+    config = StubConfig()
+
+    def setup(self):
+        super().setup()
+        with self.config.lock:
+            self.config.connections += 1
+        time.sleep(self.config.handshake_ms / 1000.0)
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        cfg = self.config
+        with cfg.lock:
+            cfg.requests += 1
+            fault = cfg.faults.pop(0) if cfg.faults else "ok"
+        if fault.isdigit():
+            code = int(fault)
+            time.sleep(cfg.ttft_ms / 1000.0)
+            self._send_json(code, {"error": {"code": code, "message": "stub fault",
+                                             "status": ERROR_STATUS.get(code, "UNKNOWN")}})
+            return
+        if fault == "reset":
+            self.close_connection = True
+            return
+        parts = split_reply(cfg.reply, cfg.chunks)
+        if ":streamGenerateContent" in self.path:
+            events = [("data: " + json.dumps(chunk_json(p, i == len(parts) - 1)) + "\r\n\r\n").encode("utf-8")
+                      for i, p in enumerate(parts)]
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Content-Length", str(sum(len(e) for e in events)))
+            self.end_headers()
+            time.sleep((cfg.ttft_ms + (cfg.slow_ms if fault == "slow" else 0)) / 1000.0)
+            for i, event in enumerate(events):
+                if i:
+                    time.sleep(cfg.chunk_ms / 1000.0)
+                    if fault == "midstream":
+                        self.close_connection = True
+                        return
+                self.wfile.write(event)
+                self.wfile.flush()
+        elif ":generateContent" in self.path:
+            time.sleep(cfg.ttft_ms / 1000.0)
+            self._send_json(200, chunk_json(cfg.reply, last=True))
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}})
+
+
+def start_stub_server(port=0, config=None):
+    """Start the stub in a daemon thread; returns (server, base_url)."""
+    handler = type("ConfiguredStubHandler", (StubHandler,), {"config": config or StubConfig()})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Local stub of the Gemini generateContent API.")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--handshake-ms", type=float, default=150)
+    ap.add_argument("--ttft-ms", type=float, default=300)
+    ap.add_argument("--chunk-ms", type=float, default=20)
+    ap.add_argument("--chunks", type=int, default=6)
+    ap.add_argument("--faults", default="", help="comma separated, one per request: 429,503,reset,slow,midstream,ok")
+    ap.add_argument("--slow-ms", type=float, default=5000)
+    args = ap.parse_args()
+    faults = [f.strip() for f in args.faults.split(",") if f.strip()]
+    config = StubConfig(args.handshake_ms, args.ttft_ms, args.chunk_ms, args.chunks,
+                        faults=faults, slow_ms=args.slow_ms)
+    server, url = start_stub_server(args.port, config)
+    print(f"Stub Gemini endpoint on {url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# main.py creates its data files and folders in the working directory on import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="ai_clone_tests_"))
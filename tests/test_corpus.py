@@ -0,0 +1,28 @@
+import pandas as pd
+
+import main
+
+
+def write_corpus_dir(tmp_path, df):
+    corpus = tmp_path / "me_corpus"
+    corpus.mkdir()
+    df.to_parquet(corpus / "part-0.parquet", index=False)
+    return str(corpus)
+
+
+def test_null_timestamp_row_loads_as_empty_string(tmp_path):
+    df = pd.DataFrame({
+        "timestamp_ms": pd.array([1700000000000, None], dtype="Int64"),
+        "sender": ["me", "friend"],
+        "text": ["hello", "no time on this one"],
+        "attachments": [[], None],
+    })
+    chats = main.corpus_to_chats(main.load_corpus(write_corpus_dir(tmp_path, df)))
+
+    assert chats[0]["timestamp"].startswith("2023-11-15T")
+    assert chats[1]["timestamp"] == ""
+    assert main.message_hash(chats[1]) == main.message_hash({"timestamp": "", "sender": "friend",
+                                                             "text": "no time on this one"})
+    chunks = list(main.chunk_chats(chats[1:]))
+    assert chunks and chunks[0][0] == ""
+    main.map_analysis_prompt(chunks[0], "friend", "")
@@ -0,0 +1,77 @@
+import random
+
+import main
+
+
+def expected_filter(reply):
+    """Filtering the whole reply line by line: directive lines go, the text before an inline directive stays."""
+    kept, directives = [], []
+    for line in reply.splitlines():
+        if not main.is_directive_line(line):
+            kept.append(line)
+            continue
+        directives.append(line)
+        low = line.lower()
+        cut = min([i for i in (low.find(d) for d in ("/save_to_memory", "/delete_from_memory")) if i != -1], default=0)
+        if line[:cut].strip():
+            kept.append(line[:cut])
+    return "\n".join(kept).strip(), directives
+
+
+REPLIES = [
+    "haan bro kal milte hai",
+    "Okay I will remember /save_to_memory gym at 6 /for 2d\nsee you there",
+    "sure\n/used_memory\nyou said you like chai\n",
+    "12\nlol\nalso /delete_from_memory old number",
+    "two lines\n\nwith a gap / and a slash that is not a directive\n/save_to_memory x",
+    "/used_memory",
+    "ends mid line /delete_from_memory 4",
+    "  /save_to_memory indented\r\n12 apples\r\n/shrug ok",
+    "a/s/save_to_memory tight",
+]
+
+
+def feed_random_chunks(reply, rng):
+    shown, directives = [], []
+    f = main.DirectiveFilter(shown.append, directives.append)
+    i = 0
+    while i < len(reply):
+        n = rng.randint(1, 8)
+        f.feed(reply[i:i + n])
+        i += n
+    f.close()
+    return f, "".join(shown), directives
+
+
+def test_random_chunking_matches_whole_reply_filter():
+    rng = random.Random(7)
+    for reply in REPLIES:
+        expected_text, expected_directives = expected_filter(reply)
+        for _ in range(200):
+            f, shown, directives = feed_random_chunks(reply, rng)
+            assert f.text.strip() == expected_text
+            assert shown == f.text
+            assert [d.rstrip("\r") for d in directives] == [d.rstrip("\r") for d in expected_directives]
+            assert "/save_to_memory" not in shown and "/delete_from_memory" not in shown
+
+
+def test_text_is_shown_before_the_line_ends():
+    shown = []
+    f = main.DirectiveFilter(shown.append, lambda line: None)
+    f.feed("haan bro")
+    assert "".join(shown) == "haan bro"
+    f.feed(" kal /sa")
+    assert "".join(shown) == "haan bro kal "
+    f.feed("ve_to_memory gym at 6\n")
+    f.close()
+    assert f.text == "haan bro kal \n"
+
+
+def test_possible_whole_line_directives_are_held():
+    shown = []
+    f = main.DirectiveFilter(shown.append, lambda line: None)
+    f.feed("12")
+    f.feed("\n/used")
+    assert shown == []
+    f.feed("_memory\nok")
+    assert "".join(shown) == "ok"
@@ -0,0 +1,43 @@
+import csv
+import json
+import os
+
+import make_csv_file
+
+
+def write_part(folder, name, messages):
+    with open(os.path.join(folder, name), "w", encoding="utf-8") as f:
+        json.dump({"participants": [{"name": "me"}, {"name": "friend"}], "messages": messages}, f)
+
+
+def csv_texts(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return [row["text"] for row in csv.DictReader(f)]
+
+
+def test_append_keeps_messages_with_the_last_timestamp(tmp_path):
+    folder = str(tmp_path / "friend_123")
+    os.makedirs(folder)
+    write_part(folder, "message_1.json", [
+        {"sender_name": "me", "timestamp_ms": 1700000001000, "content": "second"},
+        {"sender_name": "friend", "timestamp_ms": 1700000000000, "content": "first"},
+    ])
+    first = make_csv_file.ingest_thread(folder, base_name="t")
+    assert first["messages"] == 2
+
+    # same millisecond as the last ingested message, plus a later one
+    write_part(folder, "message_1.json", [
+        {"sender_name": "me", "timestamp_ms": 1700000002000, "content": "fourth"},
+        {"sender_name": "friend", "timestamp_ms": 1700000001000, "content": "third, same ms"},
+        {"sender_name": "me", "timestamp_ms": 1700000001000, "content": "second"},
+        {"sender_name": "friend", "timestamp_ms": 1700000000000, "content": "first"},
+    ])
+    second = make_csv_file.ingest_thread(folder, base_name="t")
+    assert not second["rebuilt"] and second["new"] == 2
+    assert sorted(csv_texts(second["csv"])) == ["first", "fourth", "second", "third, same ms"]
+
+    # the part file changes again but holds no new message: nothing is appended twice
+    with open(os.path.join(folder, "message_1.json"), "a", encoding="utf-8") as f:
+        f.write("\n")
+    third = make_csv_file.ingest_thread(folder, base_name="t")
+    assert third["new"] == 0 and len(csv_texts(third["csv"])) == 4